@@ -1,15 +1,104 @@
 import os
-import shutil
 import subprocess
-from glob import glob
+from glob import iglob
+import time
 from pathlib import Path
 
-from madmeasurer.helpers import mount_if_necessary
+from madmeasurer.helpers import mount_if_necessary, get_measure_source_size
+from madmeasurer.metrics import search_seconds, discs_scanned, bd_open_seconds, bd_process_seconds, \
+    measurement_checks, measurements_running, measurements, measurement_seconds, measured_bytes, failures
 from madmeasurer.title_finder import get_main_titles, get_main_title_by_duration, get_main_title_by_mpc_be, \
     get_main_title_by_jriver
+from madmeasurer import disc_index
+from madmeasurer.copier import copy_batch
 from madmeasurer.describe import describe_bd
+from madmeasurer.hdr import should_measure_dynamic_range
+from madmeasurer.memory import disc_report, process_disc
+from madmeasurer.planner import record_measurement
+from madmeasurer.probe import PROBERS, probe_all
 
 
+def get_file_types(args):
+    '''
+    Gets the types of file to search for.
+    :param args: the cli args.
+    :return: the match types.
+    '''
+    file_types = []
+    if args.iso is True:
+        file_types.append('*.iso')
+    else:
+        if args.extension is not None and len(args.extension) > 0:
+            for e in args.extension:
+                file_types.append(f"*.{e}")
+        else:
+            file_types.append('BDMV/index.bdmv')
+    return file_types
+
+
+def iter_searches(paths, args):
+    '''
+    Expands the search paths into the individual searches to make.
+    :param paths: the search paths.
+    :param args: the cli args.
+    :return: a generator of (path, match_type, depth).
+    '''
+    from madmeasurer.loggers import main_logger
+    file_types = get_file_types(args)
+    for p in paths:
+        if p[-14:] == 'index.bluray;1':
+            new_path = p[0:-19]
+            main_logger.info(f"J River library entry detected, swapping {p} for {new_path}")
+            p = new_path
+        for file_type in file_types:
+            if os.path.exists(p) and os.path.isfile(p):
+                yield p, file_type, 0
+            else:
+                if args.exact_depth is not None or args.max_depth is not None:
+                    if args.exact_depth is not None:
+                        min_depth = args.exact_depth
+                        max_depth = min_depth
+                    else:
+                        min_depth = 0
+                        max_depth = args.max_depth
+                    for depth in range(min_depth, max_depth + 1):
+                        yield p, file_type, depth
+                else:
+                    yield p, file_type, -1
+
+
+def get_glob(path, match_type, depth):
+    '''
+    Creates the glob to search with.
+    :param path: the search path.
+    :param match_type: the type of file to find.
+    :param depth: the search depth.
+    :return: the glob and whether it finds index.bdmv files.
+    '''
+    depth = '/**' if depth == -1 else ''.join(['/*'] * depth)
+    if os.path.exists(path) and os.path.isfile(path):
+        return path, Path(path).name == 'index.bdmv'
+    if path[-1] == '/' or path[-1] == '\\':
+        path = path[0:-1]
+    return f"{path}{depth}/{match_type}", match_type == 'BDMV/index.bdmv'
+
+
+def find_targets(path, match_type, depth):
+    '''
+    Lazily finds the targets in the given path.
+    :param path: the search path.
+    :param match_type: the type of file to find.
+    :param depth: the search depth.
+    :return: a generator of (absolute path to the BD root or file, is_index_bdmv).
+    '''
+    glob_str, is_index_bdmv = get_glob(path, match_type, depth)
+    for match in iglob(glob_str, recursive=True):
+        target = match if not is_index_bdmv else str(Path(match).parent.parent)
+        discs_scanned.inc(type='bd' if is_index_bdmv else match_type[2:])
+        yield os.path.abspath(target), is_index_bdmv
+
+
+@search_seconds.time()
 def search_path(path, args, match_type, depth):
     '''
     Searches for BDs to handle in the given path.
@@ -19,58 +108,48 @@ def search_path(path, args, match_type, depth):
     :param the search depth:
     '''
     from madmeasurer.loggers import main_logger
-    depth = '/**' if depth == -1 else ''.join(['/*'] * depth)
-    if os.path.exists(path) and os.path.isfile(path):
-        glob_str = path
-        is_index_bdmv = Path(path).name == 'index.bdmv'
-    else:
-        if path[-1] == '/' or path[-1] == '\\':
-            path = path[0:-1]
-        glob_str = f"{path}{depth}/{match_type}"
+    glob_str, _ = get_glob(path, match_type, depth)
+    if glob_str != path:
         main_logger.info(f"Searching {glob_str}")
-        is_index_bdmv = match_type == 'BDMV/index.bdmv'
 
     match_type_desc = 'BD' if match_type == 'BDMV/index.bdmv' else match_type[2:] + ' file'
     bds_processed = 0
-    for match in glob(glob_str, recursive=True):
-        if bds_processed > 0 and bds_processed % 10 == 0:
-            main_logger.warning(f"Processed {bds_processed} {match_type_desc}s")
-        target = match if not is_index_bdmv else str(Path(match).parent.parent)
-        if is_index_bdmv or match_type == '*.iso':
-            open_and_process_bd(args, os.path.abspath(target), is_index_bdmv)
-            bds_processed = bds_processed + 1
-        elif match_type[2:] == 'mkv':
-            process_mkv(os.path.abspath(target), args)
-        else:
-            main_logger.info(f"Target found for {match_type}, measuring {target}")
-            do_measure_if_necessary(os.path.abspath(target), args)
+    targets = find_targets(path, match_type, depth)
+    if match_type[2:] in PROBERS and args.include_hd is False:
+        for target, probe_result in probe_all((t for t, _ in targets), match_type[2:], args):
+            process_probed_file(target, probe_result, args)
+    else:
+        for target, is_index_bdmv in targets:
+            if bds_processed > 0 and bds_processed % 10 == 0:
+                main_logger.warning(f"Processed {bds_processed} {match_type_desc}s")
+            if is_index_bdmv or match_type == '*.iso':
+                if args.disc_worker is not None:
+                    args.disc_worker.process(target, is_index_bdmv)
+                else:
+                    disc_report.record(target, *process_disc(args, target, is_index_bdmv))
+                bds_processed = bds_processed + 1
+            else:
+                main_logger.info(f"Target found for {match_type}, measuring {target}")
+                do_measure_if_necessary(target, args)
 
     main_logger.warning(f"Completed search of {glob_str}, processed {bds_processed} {match_type_desc}{'' if bds_processed == 1 else 's'}")
 
 
-def process_mkv(target, args):
+def process_probed_file(target, probe_result, args):
     '''
-    Examines the mkv with enzyme and checks if it is a UHD file.
-    :param args: the cli args.
+    Measures the file if the probe found it to be a UHD file.
     :param target: the full path to the matched file.
+    :param probe_result: the probe result, None if the file could not be probed.
+    :param args: the cli args.
     '''
-    if args.include_hd is True or __is_uhd_mkv(target) is True:
+    if args.include_hd is True or (probe_result is not None and probe_result['is_uhd'] is True):
         do_measure_if_necessary(target, args)
     else:
         from madmeasurer.loggers import main_logger
         main_logger.info(f"Ignoring {target}, is not UHD and include-hd is false")
 
 
-def __is_uhd_mkv(target):
-    with open(target, 'rb') as mkv_f:
-        import enzyme
-        mkv = enzyme.MKV(mkv_f)
-        if len(mkv.video_tracks) > 0:
-            uhd_track = next((v for v in mkv.video_tracks if v.display_width > 1920), None)
-            return uhd_track is not None
-    return False
-
-
+@bd_process_seconds.time()
 def open_and_process_bd(args, target, is_bdmv):
     '''
     Opens the BD with libbluray and processes it.
@@ -79,17 +158,21 @@ def open_and_process_bd(args, target, is_bdmv):
     :param target: the path to the root of the BD.
     :param is_bdmv: true if the search target was an index.bdmv
     '''
-    from madmeasurer.loggers import main_logger
+    from madmeasurer.loggers import main_logger, emit_event
     import bluread
     main_logger.info(f"Opening {target}")
+    emit_event('disc_found', path=target)
     with bluread.Bluray(target) as bd:
         try:
-            bd.Open(flags=0x03, min_duration=args.min_duration * 60)
+            with bd_open_seconds.time():
+                bd.Open(flags=0x03, min_duration=args.min_duration * 60)
             process_bd(bd, is_bdmv, args)
         except Exception as e:
             if 'Failed to get titles' in str(e):
+                failures.inc(cause='bd_no_titles')
                 main_logger.info(f"{target} has no titles longer than {args.min_duration}, ignoring")
             else:
+                failures.inc(cause='bd_read')
                 main_logger.exception(f"Unable to read {target}, ignoring")
     main_logger.info(f"Closing {target}")
 
@@ -102,7 +185,7 @@ def process_bd(bd, is_bdmv, args):
     :param args: the cli args.
     '''
     from madmeasurer.loggers import main_logger, output_logger, csv_logger
-    with mount_if_necessary(bd.Path, args) as bd_folder_path:
+    with mount_if_necessary(bd.Path, args) as bd_folder_path, disc_index.indexed(bd_folder_path):
         if args.measure is True or args.copy is True:
             process_measurements(bd, bd_folder_path, args)
         elif args.analyse_main_algos is True:
@@ -114,6 +197,7 @@ def process_bd(bd, is_bdmv, args):
             csv_logger.error(f"\"{bd.Path}\",{m1},{m2},{m3},{m4},{m5},{len({m1, m2, m3, m4, m5})}")
         else:
             main_titles = get_main_titles(bd, bd_folder_path, args).values()
+            __emit_titles_chosen(bd, main_titles)
             if is_any_title_uhd(bd.Path, main_titles) or args.include_hd is True:
                 if args.silent:
                     for t in main_titles:
@@ -139,6 +223,7 @@ def process_measurements(bd, bd_folder_path, args):
     '''
     from madmeasurer.loggers import main_logger
     main_titles = get_main_titles(bd, bd_folder_path, args)
+    __emit_titles_chosen(bd, main_titles.values())
     if args.measure is True:
         for title_number in range(bd.NumberOfTitles):
             measure_it = False
@@ -147,17 +232,15 @@ def process_measurements(bd, bd_folder_path, args):
                 if title_number in main_titles.keys():
                     measure_it = True
                     main_logger.debug(f"Measurement candidate {bd.Path} - {title.Playlist} : main title")
-                elif args.measure_all_playlists is True:
-                    from bluread.objects import TicksToTuple
-                    title_duration = TicksToTuple(title.Length)
-                    title_duration_mins = (title_duration[0] * 60) + title_duration[1]
-                    if title_duration_mins >= args.min_duration:
-                        if args.max_duration is None or title_duration_mins <= args.max_duration:
-                            main_logger.info(f"Measurement candidate {bd.Path} - {title.Playlist} : length is {title.LengthFancy}")
-                            measure_it = True
+                elif is_wanted_extra(title, args):
+                    main_logger.info(f"Measurement candidate {bd.Path} - {title.Playlist} : length is {title.LengthFancy}")
+                    measure_it = True
+                if measure_it is True:
+                    measure_it = should_measure_dynamic_range(bd_folder_path, title, args)
                 if measure_it is True:
                     playlist_file = os.path.join(bd_folder_path, 'BDMV', 'PLAYLIST', title.Playlist)
-                    do_measure_if_necessary(playlist_file, args)
+                    do_measure_if_necessary(playlist_file, args, duration=title.Length / 90000,
+                                            is_main=title_number in main_titles.keys())
                 else:
                     main_logger.debug(f"No measurement required for {bd.Path} - {title.Playlist}")
             else:
@@ -168,6 +251,27 @@ def process_measurements(bd, bd_folder_path, args):
             copy_measurements(bd.Path, t.Playlist, args)
 
 
+def is_wanted_extra(title, args):
+    '''
+    :param title: a title which is not a main title.
+    :param args: the cli args.
+    :return: true if all playlists are to be measured and the title is within the duration limits.
+    '''
+    if args.measure_all_playlists is False:
+        return False
+    from bluread.objects import TicksToTuple
+    title_duration = TicksToTuple(title.Length)
+    title_duration_mins = (title_duration[0] * 60) + title_duration[1]
+    return title_duration_mins >= args.min_duration \
+        and (args.max_duration is None or title_duration_mins <= args.max_duration)
+
+
+def __emit_titles_chosen(bd, main_titles):
+    from madmeasurer.loggers import emit_event
+    for t in main_titles:
+        emit_event('title_chosen', path=bd.Path, playlist=t.Playlist, duration=t.LengthFancy)
+
+
 def is_any_title_uhd(bdmv_root, titles):
     '''
     determines if the disc is a UHD
@@ -198,24 +302,51 @@ def is_any_title_uhd(bdmv_root, titles):
     return is_uhd
 
 
-def do_measure_if_necessary(target_file, args):
+def do_measure_if_necessary(target_file, args, duration=None, is_main=False):
     '''
     Triggers madMeasureHDR if the title is a UHD and the measurements file for the playlist does not exist.
     :param target_file: the file to measure
     :param args: the cli args.
+    :param duration: the content duration in seconds, if known.
+    :param is_main: true if the target is a main title.
+    :return: the result of run_mad_measure_hdr if it was triggered here, None if no measurement was required or it was
+    handed to the coordinator or planner.
     '''
     from madmeasurer.loggers import main_logger
     measurement_file = f"{target_file}.measurements"
     incomplete_measurements_file = f"{measurement_file}.incomplete"
-    if os.path.exists(measurement_file):
+    if disc_index.exists(measurement_file):
+        measurement_checks.inc(result='exists')
         trigger_it = __should_trigger_measurement(args, measurement_file)
-    elif os.path.exists(incomplete_measurements_file):
+    elif disc_index.exists(incomplete_measurements_file):
+        measurement_checks.inc(result='incomplete')
         trigger_it = __should_trigger_measurement(args, incomplete_measurements_file)
     else:
+        measurement_checks.inc(result='missing')
         main_logger.info(f"Measuring : {measurement_file} does not exist")
         trigger_it = True
     if trigger_it:
-        run_mad_measure_hdr(target_file, args)
+        return dispatch_measurement(target_file, args, duration=duration, is_main=is_main)
+    return None
+
+
+def dispatch_measurement(target_file, args, duration=None, is_main=False):
+    '''
+    Hands the measurement to the coordinator or planner, if there is one, otherwise measures it now.
+    :param target_file: the file to measure
+    :param args: the cli args.
+    :param duration: the content duration in seconds, if known.
+    :param is_main: true if the target is a main title.
+    :return: the result of run_mad_measure_hdr if it was measured here, None if it was handed to the coordinator or
+    planner.
+    '''
+    if args.coordinator is not None:
+        args.coordinator.submit(target_file)
+    elif args.planner is not None:
+        args.planner.submit(target_file, duration=duration, is_main=is_main)
+    else:
+        return run_mad_measure_hdr(target_file, args, duration=duration)
+    return None
 
 
 def __should_trigger_measurement(args, measurement_file):
@@ -228,29 +359,47 @@ def __should_trigger_measurement(args, measurement_file):
         return False
 
 
-def run_mad_measure_hdr(measure_target, args):
+def run_mad_measure_hdr(measure_target, args, duration=None):
     '''
-    triggers madMeasureHDR and bridges the stdout back to this process stdout live
+    triggers madMeasureHDR and bridges the stdout back to this process stdout live, mounting the iso first if the
+    target is in an iso sidecar.
     :param args: the cli args.
     :param measure_target: file to measure.
+    :param duration: the content duration in seconds, if known, recorded in the measurement history.
+    :return: true if the measurement completed ok (or would have, if this is a dry run).
     '''
-    from madmeasurer.loggers import main_logger, output_logger
+    from madmeasurer.sidecar import measurement_target
+    with measurement_target(measure_target, args) as target:
+        if target is None:
+            failures.inc(cause='iso_mount')
+            return False
+        return __run_mad_measure_hdr(target, args, duration)
+
+
+def __run_mad_measure_hdr(measure_target, args, duration):
+    from madmeasurer.loggers import main_logger, output_logger, output_rate_limit, event_rate_limit, emit_event
     exe = "" if args.mad_measure_path is None else f"{args.mad_measure_path}{os.path.sep}"
     command = [os.path.abspath(f"{exe}madMeasureHDR.exe"), os.path.abspath(measure_target)]
     if args.dry_run is True:
         main_logger.error(f"DRY RUN! Triggering : {command}")
+        return True
     else:
         if not os.path.isfile(command[0]):
             main_logger.error(f"FAILED! madMeasureHDR.exe not found at {command[0]}")
+            failures.inc(cause='exe_not_found')
+            return False
         else:
             main_logger.info(f"Triggering : {command}")
+            emit_event('job_started', target=command[1])
             txt_output = os.path.abspath(f"{measure_target}-madvr.txt")
-            with open(txt_output, 'w') as details:
+            start = time.monotonic()
+            with open(txt_output, 'w') as details, measurements_running.track_inprogress():
                 process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=4)
                 line_num = 0
                 output = None
                 tmp_output = None
                 while True:
+                    is_progress = line_num == 1
                     if line_num == 0:
                         output = process.stdout.readline().decode('utf-8')
                         line_num = 1
@@ -269,20 +418,50 @@ def run_mad_measure_hdr(measure_target, args):
                             break
                         if output:
                             txt = output.strip()
-                            output_logger.error(txt)
+                            output_logger.error(txt, extra={'progress': is_progress})
+                            if is_progress:
+                                emit_event('job_progress', progress=True, target=command[1], status=txt)
                             details.write(txt + '\n')
                             details.flush()
                     output = None
+                # the final progress update is always shown even if it arrived within the progress interval
+                dropped = output_rate_limit.pop_dropped()
+                if dropped is not None:
+                    output_logger.error(dropped.getMessage(), extra={'progress': False})
+                dropped = event_rate_limit.pop_dropped()
+                if dropped is not None:
+                    emit_event('job_progress', **dropped.event_fields)
                 rc = process.poll()
+                disc_index.refresh(measure_target)
+                elapsed = time.monotonic() - start
+                size = __get_source_size(measure_target)
+                measurement_seconds.observe(elapsed)
+                record_measurement(args.history_file, command[1], duration, size, elapsed, rc == 0)
                 if rc == 0:
                     main_logger.error(f"Completed OK {command}")
+                    measurements.inc(result='ok')
+                    measured_bytes.inc(size)
                 else:
                     main_logger.error(f"FAILED {command}")
+                    measurements.inc(result='failed')
+                    failures.inc(cause='measure_exit_code')
+                emit_event('job_finished', target=command[1], ok=rc == 0, rc=rc)
+                return rc == 0
+
+
+def __get_source_size(measure_target):
+    from madmeasurer.loggers import main_logger
+    try:
+        return get_measure_source_size(measure_target)
+    except Exception:
+        main_logger.exception(f"Unable to determine size of {measure_target}")
+        return 0
 
 
 def copy_measurements(bd_folder_path, main_playlist, args):
     '''
-    Copies an existing index.bdmv measurements file to the correct location for the main title.
+    Queues a copy of an existing index.bdmv measurements file to the correct location for the main title, the copies
+    are made by copy_batch once the search completes.
     :param bd_folder_path: the bd folder path.
     :param main_playlist: the main playlist file name.
     :param args: the cli args.
@@ -291,8 +470,8 @@ def copy_measurements(bd_folder_path, main_playlist, args):
     src_file = os.path.join(bd_folder_path, 'BDMV', 'index.bdmv.measurements')
     dest_file = os.path.join(bd_folder_path, 'BDMV', 'PLAYLIST', f"{main_playlist}.measurements")
     copy_it = False
-    if os.path.exists(src_file):
-        if os.path.exists(dest_file):
+    if disc_index.exists(src_file):
+        if disc_index.exists(dest_file):
             if args.force is True:
                 main_logger.info(f"Overwriting : {src_file} with {dest_file} as force=True")
                 copy_it = True
@@ -304,9 +483,5 @@ def copy_measurements(bd_folder_path, main_playlist, args):
     else:
         main_logger.info(f"Ignoring : {src_file}, does not exist")
     if copy_it:
-        if args.dry_run is True:
-            main_logger.warning(f"DRY RUN! Copying {src_file} to {dest_file}")
-        else:
-            main_logger.warning(f"Copying {src_file} to {dest_file}")
-            shutil.copy2(src_file, dest_file)
-            main_logger.warning(f"Copied {src_file} to {dest_file}")
+        main_logger.info(f"Queueing copy of {src_file} to {dest_file}")
+        copy_batch.add(src_file, dest_file, size=disc_index.getsize(src_file))
@@ -1,9 +1,19 @@
 import argparse
+import atexit
 import logging
+import multiprocessing
 import os
 import sys
-from madmeasurer.loggers import main_logger, csv_logger, output_handler
-from madmeasurer import search_path
+from madmeasurer.loggers import main_logger, csv_logger, output_handler, route, BatchingFileHandler, enable_events, \
+    set_progress_interval
+from madmeasurer import search_path, iter_searches
+from madmeasurer.distributed import Coordinator, run_worker, parse_address
+from madmeasurer import metrics
+from madmeasurer.copier import copy_batch
+from madmeasurer.hdr import parse_formats, DYNAMIC_RANGES, DEFAULT_MEASURE_FORMATS
+from madmeasurer.memory import DiscWorker, disc_report, parse_size
+from madmeasurer.planner import BudgetPlanner, parse_duration, DEFAULT_HISTORY_FILE
+from madmeasurer.probe import DEFAULT_PROBE_CACHE
 
 
 class EnvDefault(argparse.Action):
@@ -26,9 +36,11 @@ class EnvDefault(argparse.Action):
 
 
 def main():
+    multiprocessing.freeze_support()
     arg_parser = argparse.ArgumentParser(description='madmeasurer for BDMV')
-    arg_parser.add_argument('paths', default=[os.getcwd()], nargs='+',
-                            help='Search paths')
+    arg_parser.add_argument('paths', nargs='*',
+                            help='Search paths, required unless --work-for is used')
+    arg_parser.set_defaults(coordinator=None, planner=None, disc_worker=None)
 
     group = arg_parser.add_argument_group('Search')
     group.add_argument('-d', '--exact-depth', type=int,
@@ -55,12 +67,22 @@ def main():
                        help='Finds the main title via the JRiver algorithm using minute resolution when comparing durations')
     group.add_argument('--include-hd', action='store_true', default=False,
                        help='Extend search to cover non UHD BDs')
+    group.add_argument('--probe-concurrency', type=int, default=4,
+                       help='Number of files (e.g. mkv found via -e) to examine concurrently')
+    group.add_argument('--probe-cache', default=DEFAULT_PROBE_CACHE,
+                       help=f"File in which to cache the result of examining files, unchanged files are not examined again (default {DEFAULT_PROBE_CACHE})")
+    group.add_argument('--iso-sidecar',
+                       help='Use with -i to extract the disc metadata from each ISO into the specified directory, the ISO is then only mounted when a measurement needs the streams (or when using -c)')
 
     group = arg_parser.add_argument_group('Measure')
     group.add_argument('-f', '--force', action='store_true', default=False,
                        help='if a playlist measurement file already exists, overwrite it from index.bdmv anyway')
     group.add_argument('-c', '--copy', action='store_true', default=False,
                        help='Copies index.bdmv.measurements to the specified main title location')
+    group.add_argument('--copy-concurrency', type=int, default=4,
+                       help='Use with -c to set the number of files copied concurrently once the search completes')
+    group.add_argument('--copy-hardlink', action='store_true', default=False,
+                       help='Use with -c to hard link the main title measurements file to index.bdmv.measurements instead of copying it, where the filesystem supports it')
     group.add_argument('-m', '--measure', action='store_true', default=False,
                        help='Calls madMeasureHDR.exe if no measurement file exists and the main title is a UHD')
     group.add_argument('--mad-measure-path', action=EnvDefault, required=False, envvar='MAD_MEASURE_HDR_PATH',
@@ -69,6 +91,33 @@ def main():
                        help='Use with -m to also measure playlists longer than min-duration (and shorter than max-duration if supplied)')
     group.add_argument('--max-duration', type=int,
                        help='Maximum playlist duration in minutes for measurements candidates, applies to --measure-all-playlists only')
+    group.add_argument('--measure-formats', type=parse_formats, default=DEFAULT_MEASURE_FORMATS,
+                       help=f"Comma separated list of the dynamic ranges to measure, titles carrying more than one are treated as the first listed in {','.join(DYNAMIC_RANGES)}, defaults to {','.join(DEFAULT_MEASURE_FORMATS)}")
+
+    group.add_argument('--time-budget', type=parse_duration,
+                       help='Use with -m to only measure what is predicted to complete within the specified time (e.g. 8h, 90m), main titles are measured first and anything which does not fit is left for the next run')
+    group.add_argument('--history-file', default=DEFAULT_HISTORY_FILE,
+                       help=f"File in which to record how long each measurement took, used to predict measurement times for --time-budget (default {DEFAULT_HISTORY_FILE})")
+
+    group = arg_parser.add_argument_group('Distributed')
+    group.add_argument('--coordinate', metavar='HOST:PORT',
+                       help='Use with -m to hand measurement jobs out to workers listening on the specified address instead of measuring locally')
+    group.add_argument('--work-for', metavar='HOST:PORT',
+                       help='Run as a worker, measuring jobs handed out by the coordinator at the specified address')
+    group.add_argument('--lease-seconds', type=int, default=60,
+                       help='How long a worker can go without a heartbeat before its job is handed to another worker')
+    group.add_argument('--max-attempts', type=int, default=3,
+                       help='Number of times a job is handed out before it is marked as failed')
+
+    group = arg_parser.add_argument_group('Memory')
+    group.add_argument('--disc-workers', action='store_true', default=False,
+                       help='Opens and processes each disc in a child process which is replaced after --recycle-after discs or once it uses more than --memory-ceiling')
+    group.add_argument('--recycle-after', type=int, default=50,
+                       help='Use with --disc-workers to set the number of discs processed before the child process is replaced')
+    group.add_argument('--memory-ceiling', type=parse_size,
+                       help='Use with --disc-workers to replace the child process once its RSS exceeds the specified size (e.g. 1G, 500M)')
+    group.add_argument('--memory-report', type=int, default=10,
+                       help='Number of discs to list in the report of the discs which used the most memory')
 
     group = arg_parser.add_argument_group('Output')
     group.add_argument('-v', '--verbose', action='count',
@@ -87,8 +136,18 @@ def main():
                        help='Specifies a debug mask to be passed as BD_DEBUG_MASK for libbluray')
     group.add_argument('--describe-bd', action='store_true', default=False,
                        help='Outputs a description of the disc in YAML format to the BD folder directory')
+    group.add_argument('--progress-interval', type=float, default=1.0,
+                       help='Minimum number of seconds between madMeasureHDR progress updates')
+    group.add_argument('--events-file',
+                       help='Writes a JSON Lines stream of events (disc_found, title_chosen, job_started, job_progress, job_finished) to the specified file, use - for stdout')
+    group.add_argument('--metrics-address', metavar='HOST:PORT',
+                       help='Exposes Prometheus metrics at http://HOST:PORT/metrics while running')
+    group.add_argument('--metrics-file',
+                       help='Writes Prometheus metrics to the specified file when the run completes')
 
     parsed_args = arg_parser.parse_args(sys.argv[1:])
+    if not parsed_args.paths and parsed_args.work_for is None:
+        arg_parser.error('the following arguments are required: paths')
     os.environ['BD_DEBUG_MASK'] = '0x0'
     if parsed_args.verbose is None or parsed_args.verbose == 0:
         main_logger.setLevel(logging.ERROR)
@@ -100,30 +159,24 @@ def main():
         main_logger.setLevel(logging.DEBUG)
         os.environ['BD_DEBUG_MASK'] = '0x00140'
 
+    set_progress_interval(parsed_args.progress_interval)
+    if parsed_args.events_file is not None:
+        enable_events(parsed_args.events_file)
+
     if parsed_args.bd_debug_mask is not None:
         main_logger.info(f"Overriding BD_DEBUG_MASK - {parsed_args.bd_debug_mask}")
         os.environ['BD_DEBUG_MASK'] = parsed_args.bd_debug_mask
 
-    file_types = []
-    if parsed_args.iso is True:
-        file_types.append('*.iso')
-    else:
-        if parsed_args.extension is not None and len(parsed_args.extension) > 0:
-            for e in parsed_args.extension:
-                file_types.append(f"*.{e}")
-        else:
-            file_types.append('BDMV/index.bdmv')
-
     if parsed_args.analyse_main_algos:
         try:
             os.mkdir('report')
         except FileExistsError:
             pass
-        csv_handler = logging.FileHandler('report/main_report.csv', mode='w+')
+        csv_handler = BatchingFileHandler('report/main_report.csv', mode='w+')
         csv_formatter = logging.Formatter('%(message)s')
         csv_handler.setFormatter(csv_formatter)
-        csv_logger.addHandler(csv_handler)
-        csv_logger.addHandler(output_handler)
+        route(csv_logger, csv_handler)
+        route(csv_logger, output_handler)
         csv_logger.error('BD,Duration,MPC-BE,libbluray,jriver,Count')
 
     if parsed_args.measure_all_playlists is True \
@@ -131,26 +184,63 @@ def main():
             and parsed_args.max_duration <= parsed_args.min_duration:
         raise ValueError(f"--max-duration {parsed_args.max_duration} is less than --min-duration {parsed_args.min_duration}")
 
-    for p in parsed_args.paths:
-        if p[-14:] == 'index.bluray;1':
-            new_path = p[0:-19]
-            main_logger.info(f"J River library entry detected, swapping {p} for {new_path}")
-            p = new_path
-        for file_type in file_types:
-            if os.path.exists(p) and os.path.isfile(p):
-                search_path(p, parsed_args, file_type, 0)
-            else:
-                if parsed_args.exact_depth is not None or parsed_args.max_depth is not None:
-                    if parsed_args.exact_depth is not None:
-                        min_depth = parsed_args.exact_depth
-                        max_depth = min_depth
-                    else:
-                        min_depth = 0
-                        max_depth = parsed_args.max_depth
-                    for depth in range(min_depth, max_depth + 1):
-                        search_path(p, parsed_args, file_type, depth)
-                else:
-                    search_path(p, parsed_args, file_type, -1)
+    if parsed_args.copy_concurrency < 1:
+        raise ValueError('--copy-concurrency must be at least 1')
+    if parsed_args.probe_concurrency < 1:
+        raise ValueError('--probe-concurrency must be at least 1')
+
+    if parsed_args.metrics_address is not None:
+        metrics.serve(parse_address(parsed_args.metrics_address))
+    if parsed_args.metrics_file is not None:
+        atexit.register(metrics.write, parsed_args.metrics_file)
+
+    if parsed_args.work_for is not None:
+        run_worker(parsed_args.work_for, parsed_args)
+        return
+
+    if parsed_args.coordinate is not None:
+        if parsed_args.measure is False:
+            raise ValueError('--coordinate requires -m')
+        if parsed_args.iso is True:
+            raise ValueError('--coordinate cannot be used with -i as isos are mounted locally')
+        parsed_args.coordinator = Coordinator(parsed_args.coordinate, lease_seconds=parsed_args.lease_seconds,
+                                              max_attempts=parsed_args.max_attempts)
+        parsed_args.coordinator.start()
+
+    if parsed_args.time_budget is not None:
+        if parsed_args.measure is False:
+            raise ValueError('--time-budget requires -m')
+        if parsed_args.iso is True and parsed_args.iso_sidecar is None:
+            raise ValueError('--time-budget can only be used with -i if --iso-sidecar is also used')
+        if parsed_args.coordinator is not None:
+            raise ValueError('--time-budget cannot be used with --coordinate')
+        parsed_args.planner = BudgetPlanner(parsed_args.time_budget, parsed_args.history_file)
+
+    disc_report.size = parsed_args.memory_report
+    if parsed_args.disc_workers is True:
+        if parsed_args.recycle_after < 1:
+            raise ValueError('--recycle-after must be at least 1')
+        if parsed_args.measure is True and parsed_args.iso is True and parsed_args.iso_sidecar is None:
+            raise ValueError('--disc-workers can only be used with -m and -i if --iso-sidecar is also used')
+        parsed_args.disc_worker = DiscWorker(parsed_args)
+
+    for p, file_type, depth in iter_searches(parsed_args.paths, parsed_args):
+        search_path(p, parsed_args, file_type, depth)
+
+    if parsed_args.disc_worker is not None:
+        parsed_args.disc_worker.stop()
+    disc_report.log()
+    copy_batch.run(parsed_args)
+
+    if parsed_args.planner is not None:
+        parsed_args.planner.run(parsed_args)
+
+    if parsed_args.coordinator is not None:
+        parsed_args.coordinator.finish_discovery()
+        main_logger.warning('Search complete, waiting for workers to finish')
+        summary = parsed_args.coordinator.wait()
+        parsed_args.coordinator.stop()
+        main_logger.error(f"Distributed measurement complete : {summary['done']} done, {summary['failed']} failed")
 
 
 if __name__ == '__main__':
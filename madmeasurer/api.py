@@ -0,0 +1,230 @@
+'''
+A python API for embedding madmeasurer in a long lived process without going via the cli, e.g.
+
+    from madmeasurer.api import Options, iter_results, submit_measurement, MISSING
+
+    options = Options(measure=True)
+    for result in iter_results(['w:/'], options):
+        if result.is_uhd:
+            for title in result.titles.values():
+                if title.should_measure is True and title.measurement == MISSING:
+                    submit_measurement(title.path, options, duration=title.duration)
+'''
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from madmeasurer import disc_index
+from madmeasurer.hdr import DEFAULT_MEASURE_FORMATS
+from madmeasurer.planner import DEFAULT_HISTORY_FILE
+from madmeasurer.probe import DEFAULT_PROBE_CACHE
+
+BD = 'bd'
+ISO = 'iso'
+FILE = 'file'
+
+COMPLETE = 'complete'
+INCOMPLETE = 'incomplete'
+MISSING = 'missing'
+
+
+@dataclass
+class Options:
+    '''
+    The options accepted by the cli which apply to the api, as a typed object.
+    '''
+    # search
+    exact_depth: Optional[int] = None
+    max_depth: Optional[int] = None
+    iso: bool = False
+    extension: List[str] = field(default_factory=list)
+    min_duration: int = 30
+    main_by_libbluray: bool = True
+    main_by_duration: bool = False
+    main_by_mpc_be: bool = False
+    main_by_jriver: bool = False
+    main_by_jriver_minute_resolution: bool = False
+    include_hd: bool = False
+    probe_concurrency: int = 4
+    probe_cache: Optional[str] = DEFAULT_PROBE_CACHE
+    iso_sidecar: Optional[str] = None
+    # measure
+    force: bool = False
+    measure: bool = False
+    mad_measure_path: Optional[str] = field(default_factory=lambda: os.environ.get('MAD_MEASURE_HDR_PATH'))
+    measure_all_playlists: bool = False
+    max_duration: Optional[int] = None
+    measure_formats: List[str] = field(default_factory=lambda: list(DEFAULT_MEASURE_FORMATS))
+    history_file: str = DEFAULT_HISTORY_FILE
+    # output
+    dry_run: bool = False
+    describe_bd: bool = False
+    # measurement job sinks, see do_measure_if_necessary
+    coordinator: object = None
+    planner: object = None
+
+    def __post_init__(self):
+        if self.iso is True and self.iso_sidecar is None:
+            raise ValueError('iso requires iso_sidecar, the paths of the titles on a mounted iso are not usable once it '
+                             'is dismounted')
+        if self.measure_all_playlists is True and self.max_duration is not None \
+                and self.max_duration <= self.min_duration:
+            raise ValueError(f"max_duration {self.max_duration} is less than min_duration {self.min_duration}")
+
+
+@dataclass
+class Target:
+    '''
+    Something found by the search.
+    '''
+    path: str
+    kind: str
+
+
+@dataclass
+class TitleResult:
+    '''
+    A main title of a disc or, with measure_all_playlists, any other title within the duration limits.
+    '''
+    playlist: str
+    path: str
+    duration: float
+    dynamic_range: Optional[str]
+    measurement: str
+    is_main: bool
+    # false if the dynamic range is not one of the measure_formats
+    should_measure: bool
+
+
+@dataclass
+class DiscResult:
+    '''
+    The analysis of a target.
+    '''
+    path: str
+    kind: str
+    is_uhd: Optional[bool] = None
+    main_titles: Dict[str, str] = field(default_factory=dict)
+    titles: Dict[str, TitleResult] = field(default_factory=dict)
+    measurement: Optional[str] = None
+    error: Optional[str] = None
+
+
+def iter_targets(paths, options) -> Iterator[Target]:
+    '''
+    Lazily searches the paths.
+    :param paths: the search paths.
+    :param options: the options.
+    :return: a generator of the targets found.
+    '''
+    from madmeasurer import iter_searches, find_targets
+    for path, match_type, depth in iter_searches(paths, options):
+        for target, is_index_bdmv in find_targets(path, match_type, depth):
+            yield Target(target, BD if is_index_bdmv else ISO if match_type == '*.iso' else FILE)
+
+
+def iter_results(paths, options) -> Iterator[DiscResult]:
+    '''
+    Lazily searches the paths and analyses each target found.
+    :param paths: the search paths.
+    :param options: the options.
+    :return: a generator of results.
+    '''
+    for target in iter_targets(paths, options):
+        yield analyse(target, options)
+
+
+def get_measurement_status(target_file):
+    '''
+    :param target_file: the file which would be measured.
+    :return: COMPLETE, INCOMPLETE or MISSING.
+    '''
+    if disc_index.exists(f"{target_file}.measurements"):
+        return COMPLETE
+    if disc_index.exists(f"{target_file}.measurements.incomplete"):
+        return INCOMPLETE
+    return MISSING
+
+
+def analyse(target, options) -> DiscResult:
+    '''
+    Analyses a target, for a disc this means finding the main title by each algorithm along with the dynamic range and
+    measurement status of the main titles chosen by the main_by options and, with measure_all_playlists, of the other
+    titles within the duration limits. The title paths of an iso are in its sidecar, submit_measurement mounts the iso
+    for the duration of the measurement.
+    :param target: the target.
+    :param options: the options.
+    :return: the result.
+    '''
+    from madmeasurer.loggers import main_logger
+    if target.kind == FILE:
+        from madmeasurer.probe import PROBERS, probe, get_probe_cache
+        result = DiscResult(target.path, target.kind, measurement=get_measurement_status(target.path))
+        extension = os.path.splitext(target.path)[1][1:].lower()
+        if extension in PROBERS:
+            probe_result = probe(target.path, extension, get_probe_cache(options.probe_cache))
+            if probe_result is None:
+                result.error = f"Unable to probe {target.path}"
+            else:
+                result.is_uhd = probe_result['is_uhd']
+        return result
+
+    if target.kind == ISO and options.iso_sidecar is None:
+        return DiscResult(target.path, target.kind, error=f"Unable to analyse {target.path}, isos require iso_sidecar")
+
+    import bluread
+    from madmeasurer import is_any_title_uhd, is_wanted_extra
+    from madmeasurer.describe import describe_bd
+    from madmeasurer.helpers import mount_if_necessary
+    from madmeasurer.hdr import get_title_dynamic_range, should_measure_dynamic_range
+    from madmeasurer.title_finder import main_title_by_algo, get_main_titles
+    result = DiscResult(target.path, target.kind)
+    with bluread.Bluray(target.path) as bd:
+        try:
+            bd.Open(flags=0x03, min_duration=options.min_duration * 60)
+            with mount_if_necessary(bd.Path, options, required=True) as bd_folder_path, \
+                    disc_index.indexed(bd_folder_path):
+                if bd_folder_path is None:
+                    raise ValueError(f"Unable to mount {target.path}")
+                result.main_titles = main_title_by_algo(bd, bd_folder_path)
+                main_titles = get_main_titles(bd, bd_folder_path, options)
+                result.is_uhd = is_any_title_uhd(bd.Path, main_titles.values())
+                for title_number in range(bd.NumberOfTitles):
+                    t = bd.GetTitle(title_number)
+                    is_main = title_number in main_titles.keys()
+                    if is_main or is_wanted_extra(t, options):
+                        playlist_file = os.path.join(bd_folder_path, 'BDMV', 'PLAYLIST', t.Playlist)
+                        result.titles[t.Playlist] = TitleResult(t.Playlist, playlist_file, t.Length / 90000,
+                                                                get_title_dynamic_range(bd_folder_path, t.Playlist),
+                                                                get_measurement_status(playlist_file), is_main,
+                                                                should_measure_dynamic_range(bd_folder_path, t,
+                                                                                             options))
+                if options.describe_bd is True:
+                    describe_bd(bd, bd_folder_path, force=options.force)
+        except Exception as e:
+            main_logger.exception(f"Unable to analyse {target.path}")
+            result.error = str(e)
+    return result
+
+
+__executor = None
+__executor_lock = threading.Lock()
+
+
+def submit_measurement(target_file, options, duration=None) -> Future:
+    '''
+    Queues a measurement of the target, measurements are run one at a time on a background thread.
+    :param target_file: the file to measure.
+    :param options: the options, force determines whether an existing measurement is replaced.
+    :param duration: the content duration in seconds, if known.
+    :return: a future which yields True if the measurement succeeded, False if it failed or None if no measurement
+    was required.
+    '''
+    from madmeasurer import do_measure_if_necessary
+    global __executor
+    with __executor_lock:
+        if __executor is None:
+            __executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='measure')
+    return __executor.submit(do_measure_if_necessary, target_file, options, duration=duration)
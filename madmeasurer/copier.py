@@ -0,0 +1,220 @@
+import hashlib
+import os
+import platform
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from madmeasurer import disc_index
+from madmeasurer.loggers import main_logger
+from madmeasurer.metrics import copies, copied_bytes
+
+COPIED = 'copied'
+IDENTICAL = 'identical'
+FAILED = 'failed'
+
+# from linux/fs.h, clones the extents of one file into another on filesystems which support it (btrfs, xfs, zfs)
+FICLONE = 0x40049409
+
+
+class CopyOp:
+    '''
+    A file to be copied.
+    '''
+
+    def __init__(self, src, dest, size):
+        self.src = src
+        self.dest = dest
+        self.size = size
+
+
+def __hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def is_identical(src, dest):
+    '''
+    :param src: the source file.
+    :param dest: the destination file.
+    :return: true if dest exists with the same size and content as src.
+    '''
+    try:
+        if os.path.getsize(src) != os.path.getsize(dest):
+            return False
+    except OSError:
+        return False
+    return __hash(src) == __hash(dest)
+
+
+def __is_same_filesystem(src, dest):
+    try:
+        return os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dest))).st_dev
+    except OSError:
+        return False
+
+
+def __reflink(src, tmp):
+    import fcntl
+    with open(src, 'rb') as s, open(tmp, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def __copy_file_range(src, tmp):
+    with open(src, 'rb') as s, open(tmp, 'wb') as d:
+        remaining = os.fstat(s.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+            if copied == 0:
+                raise OSError(f"copy_file_range made no progress copying {src}")
+            remaining -= copied
+
+
+def __copy_file_on_windows(src, tmp):
+    import ctypes
+    from ctypes import wintypes
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    copy_file_ex = kernel32.CopyFileExW
+    copy_file_ex.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, ctypes.c_void_p, ctypes.c_void_p,
+                             ctypes.POINTER(wintypes.BOOL), wintypes.DWORD]
+    copy_file_ex.restype = wintypes.BOOL
+    if not copy_file_ex(src, tmp, None, None, None, 0):
+        raise ctypes.WinError(ctypes.get_last_error())
+
+
+def __copy_to(src, tmp, hardlink):
+    '''
+    Copies src to tmp by the cheapest method available, the kernel side methods are only attempted if both files are on
+    the same filesystem and each falls through to the next if it is not supported. Otherwise CopyFileEx is used on
+    Windows, so SMB shares can copy server side, and shutil.copy2 elsewhere.
+    :return: the method used.
+    '''
+    if __is_same_filesystem(src, tmp):
+        if hardlink is True:
+            try:
+                os.link(src, tmp)
+                return 'hardlink'
+            except OSError:
+                pass
+        try:
+            __reflink(src, tmp)
+            return 'reflink'
+        except (ImportError, OSError):
+            pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                __copy_file_range(src, tmp)
+                return 'copy_file_range'
+            except OSError:
+                pass
+    if platform.system() == "Windows":
+        # CopyFileEx lets an SMB share copy the file server side rather than sending it to this machine and back
+        __copy_file_on_windows(src, tmp)
+        return 'CopyFileEx'
+    shutil.copy2(src, tmp)
+    return 'copy'
+
+
+def copy_file(src, dest, hardlink=False):
+    '''
+    Copies src to dest via a temporary file which is renamed into place so that dest is never seen half written. The
+    copy is skipped if dest already has the same content.
+    :param src: the source file.
+    :param dest: the destination file.
+    :param hardlink: if true then link dest to src instead of copying, where possible.
+    :return: (IDENTICAL or COPIED, the method used).
+    '''
+    if is_identical(src, dest):
+        return IDENTICAL, None
+    tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        method = __copy_to(src, tmp, hardlink)
+        if method in ('reflink', 'copy_file_range'):
+            shutil.copystat(src, tmp)
+        os.replace(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    disc_index.refresh(dest)
+    return COPIED, method
+
+
+class CopyBatch:
+    '''
+    Gathers the copies found by the search so they can be run together, concurrently, once the search completes.
+    '''
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__ops = {}
+
+    def add(self, src, dest, size=None):
+        '''
+        Queues a copy, a later copy to the same destination replaces an earlier one.
+        :param src: the source file.
+        :param dest: the destination file.
+        :param size: the size of the source, if known.
+        '''
+        self.extend([CopyOp(src, dest, size)])
+
+    def extend(self, ops):
+        '''
+        :param ops: the copies to queue.
+        '''
+        with self.__lock:
+            for op in ops:
+                self.__ops[os.path.normcase(os.path.abspath(op.dest))] = op
+
+    def drain(self):
+        '''
+        :return: the queued copies, leaving the batch empty.
+        '''
+        with self.__lock:
+            ops = list(self.__ops.values())
+            self.__ops = {}
+        return ops
+
+    def run(self, args):
+        '''
+        Runs the queued copies, or logs what would be copied on a dry run.
+        :param args: the cli args.
+        :return: the number of copies by outcome.
+        '''
+        ops = self.drain()
+        results = {COPIED: 0, IDENTICAL: 0, FAILED: 0}
+        if not ops:
+            return results
+        total = sum(op.size or 0 for op in ops)
+        if args.dry_run is True:
+            for op in ops:
+                main_logger.warning(f"DRY RUN! Copying {op.src} to {op.dest} ({op.size} bytes)")
+            main_logger.error(f"DRY RUN! Planned {len(ops)} copies totalling {total} bytes")
+            return results
+
+        def execute(op):
+            try:
+                result, method = copy_file(op.src, op.dest, hardlink=args.copy_hardlink)
+                if result == IDENTICAL:
+                    main_logger.info(f"Ignoring : {op.dest} is identical to {op.src}")
+                else:
+                    copied_bytes.inc(op.size or 0)
+                    main_logger.warning(f"Copied {op.src} to {op.dest} via {method}")
+            except OSError:
+                main_logger.exception(f"Unable to copy {op.src} to {op.dest}")
+                result = FAILED
+            copies.inc(result=result)
+            return result
+
+        main_logger.warning(f"Copying {len(ops)} files totalling {total} bytes")
+        with ThreadPoolExecutor(max_workers=args.copy_concurrency, thread_name_prefix='copy') as executor:
+            for result in executor.map(execute, ops):
+                results[result] += 1
+        main_logger.error(f"Copy complete : {results[COPIED]} copied, {results[IDENTICAL]} identical, "
+                          f"{results[FAILED]} failed")
+        return results
+
+
+copy_batch = CopyBatch()
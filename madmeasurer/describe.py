@@ -2,6 +2,8 @@ import os
 
 import yaml
 
+from madmeasurer import disc_index
+from madmeasurer.hdr import get_clip_dynamic_ranges, summarise_dynamic_range
 from madmeasurer.loggers import main_logger
 from madmeasurer.title_finder import main_title_by_algo
 
@@ -15,7 +17,7 @@ def describe_bd(bd, bd_folder_path, force=False, verbose=False):
     :param verbose: if true, dump the output to the screen
     '''
     output_file = os.path.join(bd_folder_path, 'disc.yaml')
-    if not os.path.exists(output_file) or force is True:
+    if not disc_index.exists(output_file) or force is True:
         details = {'name': bd.Path, 'title_count': bd.NumberOfTitles,
                    'main_titles': main_title_by_algo(bd, bd_folder_path)}
         titles = []
@@ -32,6 +34,10 @@ def describe_bd(bd, bd_folder_path, force=False, verbose=False):
                 chapters.append(chapter)
             title['chapters'] = chapters
 
+            clip_info = get_clip_dynamic_ranges(bd_folder_path, t.Playlist)
+            title['dynamic_range'] = summarise_dynamic_range(clip_info)
+            title['clip_info'] = clip_info
+
             title['clip_count'] = t.NumberOfClips
             clips = []
             for clip_number in range(t.NumberOfClips):
@@ -73,3 +79,4 @@ def describe_bd(bd, bd_folder_path, force=False, verbose=False):
             yaml.dump(details, f)
             if verbose is True:
                 main_logger.debug(yaml.dump(details))
+        disc_index.refresh(output_file)
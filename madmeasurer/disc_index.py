@@ -0,0 +1,107 @@
+import os
+import threading
+from contextlib import contextmanager
+
+__lock = threading.RLock()
+# normalised directory path -> {normalised name: os.DirEntry} or None if not yet listed
+__listings = {}
+
+
+def _normalise(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+@contextmanager
+def indexed(bd_folder_path):
+    '''
+    A context manager which answers existence checks for files in the disc root, BDMV and BDMV/PLAYLIST from a single
+    directory listing of each, rather than a round trip per file, while the disc is being processed. Size and mtime
+    checks are only answered from the listing on Windows, elsewhere os.DirEntry.stat() still makes a stat call per
+    file.
+    :param bd_folder_path: the bd folder path, if None then nothing is indexed.
+    '''
+    dirs = []
+    if bd_folder_path is not None:
+        dirs = [_normalise(d) for d in (bd_folder_path,
+                                        os.path.join(bd_folder_path, 'BDMV'),
+                                        os.path.join(bd_folder_path, 'BDMV', 'PLAYLIST'))]
+    with __lock:
+        for d in dirs:
+            __listings.setdefault(d, None)
+    try:
+        yield
+    finally:
+        with __lock:
+            for d in dirs:
+                __listings.pop(d, None)
+
+
+def __lookup(path):
+    '''
+    :param path: the path.
+    :return: (indexed, entry) where indexed is false if the path is not in an indexed directory.
+    '''
+    directory, name = os.path.split(_normalise(path))
+    with __lock:
+        if directory not in __listings:
+            return False, None
+        listing = __listings[directory]
+        if listing is None:
+            try:
+                with os.scandir(directory) as it:
+                    listing = {os.path.normcase(e.name): e for e in it}
+            except OSError:
+                listing = {}
+            __listings[directory] = listing
+        return True, listing.get(name)
+
+
+def refresh(path):
+    '''
+    Discards the listing of the directory containing the path so the next check sees any files written since.
+    :param path: a path in the directory to refresh.
+    '''
+    directory = os.path.dirname(_normalise(path))
+    with __lock:
+        if directory in __listings:
+            __listings[directory] = None
+
+
+def exists(path):
+    '''
+    An indexed os.path.exists.
+    :param path: the path.
+    :return: true if it exists.
+    '''
+    is_indexed, entry = __lookup(path)
+    if is_indexed:
+        return entry is not None
+    return os.path.exists(path)
+
+
+def getsize(path):
+    '''
+    An indexed os.path.getsize, this only saves a stat call on Windows.
+    :param path: the path.
+    :return: the size in bytes.
+    '''
+    is_indexed, entry = __lookup(path)
+    if is_indexed:
+        if entry is None:
+            raise FileNotFoundError(path)
+        return entry.stat().st_size
+    return os.path.getsize(path)
+
+
+def getmtime(path):
+    '''
+    An indexed os.path.getmtime, this only saves a stat call on Windows.
+    :param path: the path.
+    :return: the modification time.
+    '''
+    is_indexed, entry = __lookup(path)
+    if is_indexed:
+        if entry is None:
+            raise FileNotFoundError(path)
+        return entry.stat().st_mtime
+    return os.path.getmtime(path)
@@ -0,0 +1,305 @@
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from madmeasurer.loggers import main_logger
+from madmeasurer.metrics import queue_depth
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def parse_address(address):
+    '''
+    Parses a host:port string.
+    :param address: the address.
+    :return: a (host, port) tuple.
+    '''
+    host, _, port = address.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"{address} is not a valid host:port")
+    return host, int(port)
+
+
+class Job:
+    '''
+    A measurement job handed out by the coordinator.
+    '''
+
+    def __init__(self, job_id, target):
+        self.job_id = job_id
+        self.target = target
+        self.state = PENDING
+        self.worker = None
+        self.expires = None
+        self.attempts = 0
+
+    def to_dict(self):
+        return {'id': self.job_id, 'target': self.target, 'attempt': self.attempts}
+
+
+class Coordinator:
+    '''
+    Hands out the measurement jobs found by the search to workers over a simple json-per-line tcp protocol. Each job is
+    leased to a worker for lease_seconds, the worker must heartbeat to keep the lease and any job whose lease expires
+    is returned to the queue (up to max_attempts times) so another worker can pick it up.
+    '''
+
+    def __init__(self, address, lease_seconds=60, max_attempts=3):
+        self.address = parse_address(address)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.__jobs = {}
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Condition()
+        self.__discovery_complete = False
+        self.__workers = set()
+        self.__dismissed = set()
+        self.__server = None
+
+    def start(self):
+        '''
+        Starts listening for workers.
+        '''
+        coordinator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if line:
+                    try:
+                        response = coordinator.handle(json.loads(line.decode('utf-8')))
+                    except Exception as e:
+                        main_logger.exception(f"Unable to handle request from {self.client_address}")
+                        response = {'error': str(e)}
+                    self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.__server = socketserver.ThreadingTCPServer(self.address, Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, name='coordinator', daemon=True).start()
+        main_logger.warning(f"Coordinator listening on {self.address[0]}:{self.address[1]}")
+
+    def stop(self):
+        '''
+        Stops listening for workers.
+        '''
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+    def submit(self, target):
+        '''
+        Queues a measurement job.
+        :param target: the file to measure.
+        '''
+        with self.__lock:
+            if any(j.target == target and j.state in (PENDING, LEASED) for j in self.__jobs.values()):
+                main_logger.info(f"Ignoring : {target} is already queued")
+                return
+            job = Job(next(self.__ids), target)
+            self.__jobs[job.job_id] = job
+            main_logger.info(f"Queued job {job.job_id} : {target}")
+            queue_depth.inc()
+            self.__lock.notify_all()
+
+    def finish_discovery(self):
+        '''
+        Signals that no more jobs will be submitted, workers are told to exit once the queue drains.
+        '''
+        with self.__lock:
+            self.__discovery_complete = True
+            self.__lock.notify_all()
+
+    def wait(self):
+        '''
+        Blocks until every job has completed or failed and then until every known worker has been told to exit (or a
+        lease period has passed).
+        :return: the jobs by state.
+        '''
+        with self.__lock:
+            while not self.__is_finished():
+                self.__reap()
+                self.__lock.wait(timeout=1)
+            self.__lock.wait_for(lambda: self.__workers <= self.__dismissed, timeout=self.lease_seconds)
+            return self.summary()
+
+    def summary(self):
+        '''
+        :return: the count of jobs in each state.
+        '''
+        with self.__lock:
+            summary = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+            for j in self.__jobs.values():
+                summary[j.state] += 1
+            return summary
+
+    def handle(self, request):
+        '''
+        Handles a request from a worker.
+        :param request: the request.
+        :return: the response.
+        '''
+        op = request.get('op')
+        worker = request.get('worker')
+        with self.__lock:
+            self.__workers.add(worker)
+            self.__reap()
+            if op == 'lease':
+                return self.__lease(worker)
+            elif op == 'heartbeat':
+                return {'ok': self.__renew(worker, request.get('id'))}
+            elif op == 'complete':
+                return {'ok': self.__complete(worker, request.get('id'), request.get('ok') is True)}
+            else:
+                raise ValueError(f"Unknown op {op}")
+
+    def __lease(self, worker):
+        job = next((j for j in self.__jobs.values() if j.state == PENDING), None)
+        if job is None:
+            if self.__is_finished():
+                self.__dismissed.add(worker)
+                self.__lock.notify_all()
+                return {'done': True}
+            return {'job': None, 'retry': 5}
+        job.state = LEASED
+        job.worker = worker
+        job.expires = time.monotonic() + self.lease_seconds
+        job.attempts += 1
+        queue_depth.dec()
+        main_logger.warning(f"Leased job {job.job_id} to {worker} : {job.target}")
+        return {'job': job.to_dict(), 'lease_seconds': self.lease_seconds}
+
+    def __renew(self, worker, job_id):
+        job = self.__jobs.get(job_id)
+        if job is not None and job.state == LEASED and job.worker == worker:
+            job.expires = time.monotonic() + self.lease_seconds
+            return True
+        main_logger.warning(f"Rejecting heartbeat from {worker} for job {job_id}, lease is not held")
+        return False
+
+    def __complete(self, worker, job_id, ok):
+        job = self.__jobs.get(job_id)
+        if job is None or job.state != LEASED or job.worker != worker:
+            main_logger.warning(f"Ignoring result from {worker} for job {job_id}, lease is not held")
+            return False
+        if ok is True:
+            job.state = DONE
+            main_logger.warning(f"Completed job {job.job_id} on {worker} : {job.target}")
+        else:
+            self.__release(job, f"failed on {worker}")
+        self.__lock.notify_all()
+        return True
+
+    def __reap(self):
+        now = time.monotonic()
+        for job in self.__jobs.values():
+            if job.state == LEASED and job.expires < now:
+                self.__release(job, f"lease held by {job.worker} expired")
+
+    def __release(self, job, reason):
+        job.worker = None
+        job.expires = None
+        if job.attempts >= self.max_attempts:
+            job.state = FAILED
+            main_logger.error(f"FAILED job {job.job_id} after {job.attempts} attempts, {reason} : {job.target}")
+        else:
+            job.state = PENDING
+            queue_depth.inc()
+            main_logger.warning(f"Requeuing job {job.job_id}, {reason} : {job.target}")
+        self.__lock.notify_all()
+
+    def __is_finished(self):
+        return self.__discovery_complete and all(j.state in (DONE, FAILED) for j in self.__jobs.values())
+
+
+def call_coordinator(address, request, timeout=30):
+    '''
+    Sends a request to the coordinator.
+    :param address: the (host, port) of the coordinator.
+    :param request: the request.
+    :param timeout: the socket timeout in seconds.
+    :return: the response.
+    '''
+    with socket.create_connection(address, timeout=timeout) as s:
+        s.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with s.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError(f"No response from coordinator at {address[0]}:{address[1]}")
+    response = json.loads(line.decode('utf-8'))
+    if 'error' in response:
+        raise ValueError(f"Coordinator rejected {request} : {response['error']}")
+    return response
+
+
+def run_worker(address, args, worker_id=None, max_connect_failures=5):
+    '''
+    Leases measurement jobs from the coordinator and runs madMeasureHDR against them until the coordinator says there
+    is nothing left to do.
+    :param address: the coordinator host:port.
+    :param args: the cli args.
+    :param worker_id: the name this worker reports to the coordinator, defaults to hostname-pid.
+    :param max_connect_failures: the number of consecutive failures to reach the coordinator before giving up.
+    :return: the number of jobs handled.
+    '''
+    from madmeasurer import run_mad_measure_hdr
+    address = parse_address(address)
+    worker_id = worker_id if worker_id is not None else f"{socket.gethostname()}-{os.getpid()}"
+    main_logger.warning(f"Worker {worker_id} connecting to {address[0]}:{address[1]}")
+    handled = 0
+    failures = 0
+    while True:
+        try:
+            response = call_coordinator(address, {'op': 'lease', 'worker': worker_id})
+            failures = 0
+        except OSError as e:
+            failures += 1
+            if failures >= max_connect_failures:
+                main_logger.error(f"Unable to reach coordinator after {failures} attempts, exiting : {e}")
+                break
+            time.sleep(5)
+            continue
+        if response.get('done') is True:
+            main_logger.warning(f"Worker {worker_id} exiting, coordinator has no more jobs")
+            break
+        job = response.get('job')
+        if job is None:
+            time.sleep(response.get('retry', 5))
+            continue
+        main_logger.warning(f"Worker {worker_id} measuring job {job['id']} : {job['target']}")
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(target=__heartbeat, daemon=True,
+                                     args=(address, worker_id, job['id'], response['lease_seconds'] / 3, stop_heartbeat))
+        heartbeat.start()
+        try:
+            ok = run_mad_measure_hdr(job['target'], args) is True
+        except Exception:
+            main_logger.exception(f"Unable to measure {job['target']}")
+            ok = False
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+        try:
+            call_coordinator(address, {'op': 'complete', 'worker': worker_id, 'id': job['id'], 'ok': ok})
+        except OSError:
+            main_logger.exception(f"Unable to report result of job {job['id']}, the coordinator will reassign it")
+        handled += 1
+    return handled
+
+
+def __heartbeat(address, worker_id, job_id, interval, stop):
+    while not stop.wait(interval):
+        try:
+            if call_coordinator(address, {'op': 'heartbeat', 'worker': worker_id, 'id': job_id}).get('ok') is not True:
+                main_logger.error(f"Lease on job {job_id} has been lost, the result will be ignored")
+                return
+        except OSError:
+            main_logger.exception(f"Unable to heartbeat job {job_id}")
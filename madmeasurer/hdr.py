@@ -0,0 +1,134 @@
+import argparse
+import os
+
+from madmeasurer.helpers import get_playlist_clip_names
+from madmeasurer.loggers import main_logger
+
+SDR = 'SDR'
+HDR10 = 'HDR10'
+HDR10_PLUS = 'HDR10+'
+DOLBY_VISION = 'DV'
+
+# in order of preference, i.e. a title carrying DV and HDR10 is a DV title
+DYNAMIC_RANGES = [DOLBY_VISION, HDR10_PLUS, HDR10, SDR]
+# SDR titles carry no HDR metadata for madVR to use so there is nothing to gain from measuring them
+DEFAULT_MEASURE_FORMATS = [DOLBY_VISION, HDR10_PLUS, HDR10]
+
+VIDEO_CODING_TYPES = {0x01: 'MPEG1', 0x02: 'MPEG2', 0x1b: 'H264', 0x20: 'H264-MVC', 0x24: 'HEVC', 0xea: 'VC1'}
+VIDEO_FORMATS = {1: '480i', 2: '576i', 3: '480p', 4: '1080i', 5: '720p', 6: '1080p', 7: '576p', 8: '2160p'}
+COLOR_SPACES = {1: 'BT.709', 2: 'BT.2020'}
+
+
+def read_clip_video_streams(clpi_file):
+    '''
+    Reads the video stream attributes from the ProgramInfo of a clpi file.
+    :param clpi_file: the clpi file.
+    :return: a list of dicts describing each video stream.
+    '''
+    with open(clpi_file, 'rb') as f:
+        data = f.read()
+    if data[0:4] != b'HDMV':
+        raise ValueError(f"{clpi_file} is not a clpi file")
+    pos = int.from_bytes(data[12:16], 'big')
+    program_count = data[pos + 5]
+    pos += 6
+    streams = []
+    for _ in range(program_count):
+        stream_count = data[pos + 6]
+        pos += 8
+        for _ in range(stream_count):
+            pid = int.from_bytes(data[pos:pos + 2], 'big')
+            attr_len = data[pos + 2]
+            attr = data[pos + 3:pos + 3 + attr_len]
+            pos += 3 + attr_len
+            coding_type = attr[0]
+            if coding_type not in VIDEO_CODING_TYPES:
+                continue
+            stream = {'pid': pid, 'coding_type': VIDEO_CODING_TYPES[coding_type], 'format': VIDEO_FORMATS.get(attr[1] >> 4),
+                      'dynamic_range': SDR, 'color_space': None, 'hdr10_plus': False}
+            if coding_type == 0x24:
+                # attr[2] = aspect:4 reserved:2 oc_flag:1 cr_flag:1, attr[3] = dynamic_range_type:4 color_space:4
+                # attr[4] = hdr_plus_flag:1 reserved:7
+                dynamic_range_type = attr[3] >> 4
+                stream['dynamic_range'] = {1: HDR10, 2: DOLBY_VISION}.get(dynamic_range_type, SDR)
+                stream['color_space'] = COLOR_SPACES.get(attr[3] & 0x0f)
+                stream['hdr10_plus'] = attr[4] >> 7 == 1
+            streams.append(stream)
+    return streams
+
+
+def get_clip_dynamic_ranges(bd_folder_path, playlist):
+    '''
+    Reads the video streams of every clip referenced by the playlist.
+    :param bd_folder_path: the bd folder path.
+    :param playlist: the playlist file name.
+    :return: a dict of clip name to video streams, or None if the clip info could not be read.
+    '''
+    try:
+        clips = get_playlist_clip_names(os.path.join(bd_folder_path, 'BDMV', 'PLAYLIST', playlist))
+        return {c: read_clip_video_streams(os.path.join(bd_folder_path, 'BDMV', 'CLIPINF', f"{c}.clpi"))
+                for c in dict.fromkeys(clips)}
+    except (OSError, ValueError, IndexError):
+        main_logger.exception(f"Unable to read clip info for {bd_folder_path} - {playlist}")
+        return None
+
+
+def get_title_dynamic_range(bd_folder_path, playlist):
+    '''
+    Determines the dynamic range of the title, if the title carries more than one kind of video (e.g. a HDR10 base
+    layer with a DV enhancement layer) then the most capable one wins.
+    :param bd_folder_path: the bd folder path.
+    :param playlist: the playlist file name.
+    :return: one of DYNAMIC_RANGES or None if it cannot be determined.
+    '''
+    return summarise_dynamic_range(get_clip_dynamic_ranges(bd_folder_path, playlist))
+
+
+def summarise_dynamic_range(clips):
+    '''
+    Reduces the video streams of a title to a single dynamic range.
+    :param clips: the output of get_clip_dynamic_ranges.
+    :return: one of DYNAMIC_RANGES or None if it cannot be determined.
+    '''
+    if not clips:
+        return None
+    found = set()
+    for streams in clips.values():
+        for s in streams:
+            found.add(s['dynamic_range'])
+            if s['hdr10_plus'] is True:
+                found.add(HDR10_PLUS)
+    return next((dr for dr in DYNAMIC_RANGES if dr in found), None)
+
+
+def should_measure_dynamic_range(bd_folder_path, title, args):
+    '''
+    Applies the --measure-formats policy to the title.
+    :param bd_folder_path: the bd folder path.
+    :param title: the title.
+    :param args: the cli args.
+    :return: true if the title should be measured.
+    '''
+    if set(args.measure_formats) >= set(DYNAMIC_RANGES):
+        return True
+    dynamic_range = get_title_dynamic_range(bd_folder_path, title.Playlist)
+    if dynamic_range is None:
+        main_logger.warning(f"Unable to determine dynamic range of {bd_folder_path} - {title.Playlist}, measuring anyway")
+        return True
+    if dynamic_range in args.measure_formats:
+        return True
+    main_logger.info(f"Ignoring {bd_folder_path} - {title.Playlist} : {dynamic_range} is not in {args.measure_formats}")
+    return False
+
+
+def parse_formats(value):
+    '''
+    Parses a comma separated list of dynamic ranges.
+    :param value: the value.
+    :return: the list.
+    '''
+    formats = [v.strip().upper() for v in value.split(',') if v.strip()]
+    for f in formats:
+        if f not in DYNAMIC_RANGES:
+            raise argparse.ArgumentTypeError(f"Unknown format {f}, must be one of {DYNAMIC_RANGES}")
+    return formats
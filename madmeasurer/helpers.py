@@ -5,19 +5,33 @@ import subprocess
 from madmeasurer.loggers import main_logger
 
 
+def __requires_mount(args):
+    main_requires_mount = args.main_by_mpc_be is True \
+                          or args.analyse_main_algos is True \
+                          or args.main_by_jriver is True \
+                          or args.main_by_jriver_minute_resolution is True
+    return args.measure is True or args.copy is True or main_requires_mount is True or args.describe_bd is True
+
+
 @contextmanager
-def mount_if_necessary(bd_path, args):
+def mount_if_necessary(bd_path, args, required=False):
     '''
-    A context manager that can mount and iso and return the mounted path then dismounts afterwards.
+    A context manager that can mount and iso and return the mounted path then dismounts afterwards. If an iso sidecar
+    store is in use, and the disc is not going to be written to, then the sidecar is returned instead.
+    :param bd_path: the bd path.
+    :param args: the cli args.
+    :param required: if true then mount regardless of what args asks for, the sidecar is used if there is one.
     '''
     target = bd_path
     mounted = False
-    main_requires_mount = args.main_by_mpc_be is True \
-                          or args.analyse_main_algos is True \
-                          or args.main_by_jriver is True \
-                          or args.main_by_jriver_minute_resolution is True
-    if args.measure is True or args.copy is True or main_requires_mount is True or args.describe_bd is True:
+    if required is True or __requires_mount(args):
         mounted = target[-4:] == '.iso'
+        if mounted is True and args.iso_sidecar is not None and (required is True or args.copy is False):
+            from madmeasurer.sidecar import get_or_extract_sidecar
+            sidecar = get_or_extract_sidecar(bd_path, args.iso_sidecar)
+            if sidecar is not None:
+                target = sidecar
+                mounted = False
         if mounted is True:
             if platform.system() == "Windows":
                 target = mount_iso_on_windows(bd_path)
@@ -70,3 +84,41 @@ def dismount_iso_on_windows(iso):
     else:
         main_logger.error(f"Unable to dismount {iso_to_dismount} , stdout: {result.stdout.decode('utf-8')}, stderr: {result.stderr.decode('utf-8')}")
 
+
+def get_playlist_clip_names(playlist_file):
+    '''
+    Reads the names of the clips referenced by the play items in an mpls file.
+    :param playlist_file: the mpls file.
+    :return: the clip names, e.g. 00001, in play order.
+    '''
+    with open(playlist_file, 'rb') as f:
+        data = f.read()
+    if data[0:4] != b'MPLS':
+        raise ValueError(f"{playlist_file} is not an mpls file")
+    pos = int.from_bytes(data[8:12], 'big')
+    item_count = int.from_bytes(data[pos + 6:pos + 8], 'big')
+    pos += 10
+    clips = []
+    for _ in range(item_count):
+        length = int.from_bytes(data[pos:pos + 2], 'big')
+        clips.append(data[pos + 2:pos + 7].decode('ascii'))
+        pos += 2 + length
+    return clips
+
+
+def get_measure_source_size(target):
+    '''
+    Gets the size of the content madMeasureHDR will read for the target, i.e. the sum of the stream files for a
+    playlist or the file size otherwise.
+    :param target: the measurement target.
+    :return: the size in bytes.
+    '''
+    if target[-5:].lower() == '.mpls':
+        stream_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(target))), 'STREAM')
+        total = 0
+        for clip in set(get_playlist_clip_names(target)):
+            clip_file = os.path.join(stream_dir, f"{clip}.m2ts")
+            if os.path.exists(clip_file):
+                total += os.path.getsize(clip_file)
+        return total
+    return os.path.getsize(target)
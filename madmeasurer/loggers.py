@@ -1,17 +1,224 @@
+import atexit
+import json
 import logging
+import queue
 import sys
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+
+class BatchingStreamHandler(logging.StreamHandler):
+    '''
+    A StreamHandler which only flushes the underlying stream once a batch of records has been written or the flush
+    interval has passed, the background writer flushes any remainder when the queue goes idle.
+    '''
+
+    def __init__(self, stream=None, batch_size=50, flush_interval=0.5):
+        super().__init__(stream)
+        self._init_batching(batch_size, flush_interval)
+
+    def _init_batching(self, batch_size, flush_interval):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        self._pending += 1
+        if self._pending >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.force_flush()
+
+    def force_flush(self):
+        self.acquire()
+        try:
+            if self._pending > 0:
+                super().flush()
+            self._pending = 0
+            self._last_flush = time.monotonic()
+        finally:
+            self.release()
+
+
+class BatchingFileHandler(logging.FileHandler, BatchingStreamHandler):
+    '''
+    A FileHandler which flushes in batches.
+    '''
+
+    def __init__(self, filename, mode='a', batch_size=50, flush_interval=0.5):
+        logging.FileHandler.__init__(self, filename, mode=mode)
+        self._init_batching(batch_size, flush_interval)
+
+    def close(self):
+        self.force_flush()
+        super().close()
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Drops progress records (i.e. those logged with extra={'progress': True}) which arrive within interval seconds of
+    the last progress record that was let through, all other records pass untouched. The most recently dropped record
+    is retained so the final progress update can be logged once the producer completes.
+    '''
+
+    def __init__(self, interval=1.0):
+        super().__init__()
+        self.interval = interval
+        self.__last = None
+        self.__dropped = None
+
+    def filter(self, record):
+        if getattr(record, 'progress', False) is True:
+            now = time.monotonic()
+            if self.__last is not None and now - self.__last < self.interval:
+                self.__dropped = record
+                return False
+            self.__last = now
+            self.__dropped = None
+        return True
+
+    def pop_dropped(self):
+        '''
+        :return: the last progress record dropped since a progress record was let through, if any.
+        '''
+        dropped, self.__dropped = self.__dropped, None
+        return dropped
+
+
+class JsonLinesFormatter(logging.Formatter):
+    '''
+    Formats an event record as a single line of json.
+    '''
+
+    def format(self, record):
+        event = {'ts': datetime.fromtimestamp(record.created).isoformat(), 'event': record.getMessage()}
+        event.update(getattr(record, 'event_fields', {}))
+        return json.dumps(event, default=str)
+
+
+class _RouteFilter(logging.Filter):
+    '''
+    Restricts a handler attached to the shared listener to the records produced by the loggers routed to it.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.names = set()
+
+    def filter(self, record):
+        return record.name in self.names
+
+
+class _BatchingQueueListener(QueueListener):
+    '''
+    A QueueListener which flushes its handlers whenever the queue has been idle for flush_interval seconds.
+    '''
+
+    def __init__(self, q, flush_interval=0.5):
+        super().__init__(q, respect_handler_level=True)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block=block, timeout=self.flush_interval if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+                self.flush()
+
+    def flush(self):
+        for handler in self.handlers:
+            if isinstance(handler, BatchingStreamHandler):
+                handler.force_flush()
+            else:
+                handler.flush()
+
+    def stop(self):
+        super().stop()
+        self.flush()
+
+
+log_queue = queue.Queue(-1)
+log_listener = _BatchingQueueListener(log_queue)
+
+
+def route(logger, handler):
+    '''
+    Routes the records produced by the logger to the handler via the background writer thread.
+    :param logger: the logger.
+    :param handler: the handler.
+    '''
+    route_filter = next((f for f in handler.filters if isinstance(f, _RouteFilter)), None)
+    if route_filter is None:
+        route_filter = _RouteFilter()
+        handler.addFilter(route_filter)
+    route_filter.names.add(logger.name)
+    if handler not in log_listener.handlers:
+        log_listener.handlers = log_listener.handlers + (handler,)
+    if not any(isinstance(h, QueueHandler) for h in logger.handlers):
+        logger.addHandler(QueueHandler(log_queue))
+
+
+def shutdown():
+    '''
+    Stops the background writer, writing out anything still on the queue.
+    '''
+    if log_listener._thread is not None:
+        log_listener.stop()
+
 
 main_logger = logging.getLogger('verbose')
-main_handler = logging.StreamHandler(sys.stdout)
+main_handler = BatchingStreamHandler(sys.stdout)
 main_formatter = logging.Formatter('%(asctime)s - %(message)s')
 main_handler.setFormatter(main_formatter)
-main_logger.addHandler(main_handler)
+route(main_logger, main_handler)
 
 output_logger = logging.getLogger('output')
-output_handler = logging.StreamHandler(sys.stdout)
+output_handler = BatchingStreamHandler(sys.stdout)
 output_formatter = logging.Formatter('%(message)s')
 output_handler.setFormatter(output_formatter)
-output_logger.addHandler(output_handler)
+output_rate_limit = RateLimitFilter()
+output_logger.addFilter(output_rate_limit)
+route(output_logger, output_handler)
 
 csv_logger = logging.getLogger('csv')
 
+event_logger = logging.getLogger('events')
+event_logger.propagate = False
+event_rate_limit = RateLimitFilter()
+event_logger.addFilter(event_rate_limit)
+
+log_listener.start()
+atexit.register(shutdown)
+
+
+def enable_events(target):
+    '''
+    Writes a JSON Lines event stream to the target.
+    :param target: a file path or - for stdout.
+    '''
+    handler = BatchingStreamHandler(sys.stdout) if target == '-' else BatchingFileHandler(target, mode='w')
+    handler.setFormatter(JsonLinesFormatter())
+    route(event_logger, handler)
+    event_logger.setLevel(logging.INFO)
+
+
+def set_progress_interval(interval):
+    '''
+    Sets the minimum interval, in seconds, between progress updates.
+    :param interval: the interval.
+    '''
+    output_rate_limit.interval = interval
+    event_rate_limit.interval = interval
+
+
+def emit_event(event, progress=False, **fields):
+    '''
+    Emits an event to the JSON Lines event stream, if enabled.
+    :param event: the event name.
+    :param progress: true if this is a progress event and hence subject to rate limiting.
+    :param fields: the event payload.
+    '''
+    if event_logger.isEnabledFor(logging.INFO):
+        event_logger.info(event, extra={'event_fields': fields, 'progress': progress})
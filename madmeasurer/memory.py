@@ -0,0 +1,306 @@
+import argparse
+import copy
+import heapq
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import re
+from logging.handlers import QueueHandler, QueueListener
+
+from madmeasurer import metrics
+from madmeasurer.loggers import main_logger
+
+# the loggers whose records are handed from a disc worker back to the parent
+FORWARDED_LOGGERS = ('verbose', 'output', 'csv', 'events')
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(value):
+    '''
+    Parses a size like 2G, 1500M or 1073741824 (bytes).
+    :param value: the value.
+    :return: the size in bytes.
+    '''
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([kmgt]?)i?b?', value.strip().lower())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"{value} is not a valid size, e.g. 2G, 1500M")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def format_size(value):
+    '''
+    :param value: a size in bytes, if known.
+    :return: the size in MB.
+    '''
+    return 'unknown' if value is None else f"{value / 1024 ** 2:.1f}MB"
+
+
+def get_rss():
+    '''
+    Uses psutil if it is installed, otherwise asks the OS directly.
+    :return: the resident set size (working set on Windows) of this process in bytes or None if it cannot be determined.
+    '''
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    if platform.system() == "Windows":
+        return __get_rss_on_windows()
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def __get_rss_on_windows():
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD),
+                    ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t),
+                    ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t),
+                    ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    counters = ProcessMemoryCounters()
+    counters.cb = ctypes.sizeof(counters)
+    get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+    get_current_process.restype = wintypes.HANDLE
+    get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+    get_process_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+    get_process_memory_info.restype = wintypes.BOOL
+    if get_process_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+        return counters.WorkingSetSize
+    return None
+
+
+class DiscMemoryReport:
+    '''
+    Tracks the discs which grew the RSS the most, only the top few are retained so the report does not itself grow
+    with the size of the library.
+    '''
+
+    def __init__(self, size=10):
+        self.size = size
+        self.discs = 0
+        self.peak = None
+        self.__top = []
+
+    def record(self, target, before, after):
+        '''
+        Records the RSS of the process which processed a disc.
+        :param target: the disc.
+        :param before: the RSS before the disc was opened, if known.
+        :param after: the RSS after the disc was closed, if known.
+        '''
+        self.discs += 1
+        if before is None or after is None:
+            return
+        metrics.disc_rss_bytes.set(after)
+        self.peak = after if self.peak is None else max(self.peak, after)
+        growth = after - before
+        main_logger.info(f"Processed {target} : RSS {format_size(before)} -> {format_size(after)}")
+        if self.size > 0:
+            entry = (growth, self.discs, target, before, after)
+            if len(self.__top) < self.size:
+                heapq.heappush(self.__top, entry)
+            else:
+                heapq.heappushpop(self.__top, entry)
+
+    def log(self):
+        '''
+        Logs the discs which used the most memory.
+        '''
+        if self.discs == 0:
+            return
+        main_logger.warning(f"Processed {self.discs} discs, peak RSS {format_size(self.peak)}")
+        for growth, _, target, before, after in sorted(self.__top, reverse=True):
+            main_logger.warning(f"  {format_size(growth)} : {target} ({format_size(before)} -> {format_size(after)})")
+
+
+disc_report = DiscMemoryReport()
+
+
+def process_disc(args, target, is_bdmv):
+    '''
+    Opens and processes the disc, sampling the RSS before and after.
+    :param args: the cli args.
+    :param target: the path to the root of the BD.
+    :param is_bdmv: true if the search target was an index.bdmv
+    :return: the RSS before and after, either may be None if the RSS cannot be determined.
+    '''
+    from madmeasurer import open_and_process_bd
+    before = get_rss()
+    open_and_process_bd(args, target, is_bdmv)
+    return before, get_rss()
+
+
+class _JobCollector:
+    '''
+    Stands in for the planner in a disc worker so that measurement jobs are handed back to the parent to be measured
+    there or passed on to the coordinator or planner.
+    '''
+
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, target, duration=None, is_main=False):
+        self.jobs.append((target, duration, is_main))
+
+    def drain(self):
+        jobs, self.jobs = self.jobs, []
+        return jobs
+
+
+class _Forwarder(logging.Handler):
+    '''
+    Hands a record received from a disc worker to the logger of the same name in this process.
+    '''
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def _run_disc_worker(args, levels, tasks, results, log_queue):
+    '''
+    The disc worker main loop, processes discs until told to stop or until it should be recycled.
+    :param args: the cli args.
+    :param levels: the level of each forwarded logger in the parent.
+    :param tasks: the queue of discs to process.
+    :param results: the queue to put the result of each disc on.
+    :param log_queue: the queue to put log records on.
+    '''
+    from madmeasurer.copier import copy_batch
+    from madmeasurer.loggers import shutdown, set_progress_interval
+    for name in FORWARDED_LOGGERS:
+        logger = logging.getLogger(name)
+        logger.handlers = [QueueHandler(log_queue)]
+        logger.setLevel(levels[name])
+    set_progress_interval(args.progress_interval)
+    shutdown()
+    processed = 0
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        before, after = process_disc(args, *task)
+        processed += 1
+        recycle = None
+        if processed >= args.recycle_after:
+            recycle = 'disc_limit'
+        elif args.memory_ceiling is not None and after is not None and after > args.memory_ceiling:
+            recycle = 'memory_ceiling'
+        results.put({
+            'before': before,
+            'after': after,
+            'processed': processed,
+            'recycle': recycle,
+            'jobs': args.planner.drain() if args.planner is not None else [],
+            'copies': copy_batch.drain(),
+            'metrics': metrics.drain()
+        })
+        if recycle is not None:
+            break
+
+
+class DiscWorker:
+    '''
+    Opens and processes discs in a child process so that whatever libbluray, bluread and the analysis leave behind is
+    released when the child exits. The child is replaced after recycle_after discs or once its RSS passes the memory
+    ceiling so peak memory does not depend on the size of the library. A disc which crashes the child is logged and
+    skipped rather than ending the run. Any measurements the disc needs are run by the parent.
+    '''
+
+    def __init__(self, args, report=disc_report):
+        self.args = args
+        self.report = report
+        self.__context = multiprocessing.get_context('spawn')
+        self.__process = None
+        self.__tasks = None
+        self.__results = None
+        self.__log_queue = self.__context.Queue(-1)
+        self.__log_listener = QueueListener(self.__log_queue, _Forwarder())
+        self.__log_listener.start()
+
+    def __start(self):
+        child_args = copy.copy(self.args)
+        child_args.disc_worker = None
+        child_args.coordinator = None
+        # measurements are handed back to the parent so they show up in its metrics and do not hold up recycling
+        child_args.planner = _JobCollector()
+        levels = {name: logging.getLogger(name).level for name in FORWARDED_LOGGERS}
+        self.__tasks = self.__context.Queue()
+        self.__results = self.__context.Queue()
+        self.__process = self.__context.Process(target=_run_disc_worker, name='disc-worker', daemon=True,
+                                                args=(child_args, levels, self.__tasks, self.__results,
+                                                      self.__log_queue))
+        self.__process.start()
+        main_logger.info(f"Started disc worker {self.__process.pid}")
+
+    def __wait(self):
+        '''
+        :return: the result of the current disc or None if the child died without producing one.
+        '''
+        while True:
+            try:
+                return self.__results.get(timeout=1)
+            except queue.Empty:
+                if not self.__process.is_alive():
+                    try:
+                        return self.__results.get(timeout=1)
+                    except queue.Empty:
+                        return None
+
+    def __discard(self):
+        self.__process.join(timeout=10)
+        if self.__process.is_alive():
+            self.__process.terminate()
+        self.__process = None
+
+    def process(self, target, is_bdmv):
+        '''
+        Opens and processes the disc in the child, starting a new child if necessary.
+        :param target: the path to the root of the BD.
+        :param is_bdmv: true if the search target was an index.bdmv
+        '''
+        from madmeasurer import dispatch_measurement
+        from madmeasurer.copier import copy_batch
+        if self.__process is None:
+            self.__start()
+        pid = self.__process.pid
+        self.__tasks.put((target, is_bdmv))
+        result = self.__wait()
+        if result is None:
+            metrics.failures.inc(cause='disc_worker_crash')
+            main_logger.error(f"Disc worker {pid} exited with code {self.__process.exitcode} while processing {target}, ignoring")
+            self.__discard()
+            return
+        metrics.merge(result['metrics'])
+        self.report.record(target, result['before'], result['after'])
+        copy_batch.extend(result['copies'])
+        for job_target, duration, is_main in result['jobs']:
+            dispatch_measurement(job_target, self.args, duration=duration, is_main=is_main)
+        if result['recycle'] is not None:
+            metrics.disc_workers_recycled.inc(reason=result['recycle'])
+            main_logger.info(f"Recycling disc worker {pid} after {result['processed']} discs ({result['recycle']}), "
+                             f"RSS {format_size(result['after'])}")
+            self.__discard()
+
+    def stop(self):
+        '''
+        Stops the child, if any.
+        '''
+        if self.__process is not None:
+            self.__tasks.put(None)
+            self.__discard()
+        self.__log_listener.stop()
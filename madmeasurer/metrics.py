@@ -0,0 +1,278 @@
+import math
+import threading
+import time
+from contextlib import ContextDecorator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from madmeasurer.loggers import main_logger
+
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 14400, math.inf)
+
+registry = []
+
+
+def __escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{__escape(v)}"' for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    '''
+    Base class for a metric which holds one value per combination of label values.
+    '''
+    metric_type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labels:
+            self._values[()] = self._initial_value()
+        registry.append(self)
+
+    def _initial_value(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels.keys()) != set(self.labels):
+            raise ValueError(f"{self.name} requires labels {self.labels}, got {tuple(labels.keys())}")
+        return tuple((k, labels[k]) for k in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    '''
+    A value which only goes up.
+    '''
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def drain(self):
+        '''
+        :return: the values accumulated since the last drain, resetting them to zero.
+        '''
+        with self._lock:
+            values = self._values
+            self._values = {key: self._initial_value() for key in values}
+        return values
+
+    def merge(self, values):
+        '''
+        Adds values drained from another process.
+        :param values: the drained values.
+        '''
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    '''
+    A value which can go up and down.
+    '''
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def track_inprogress(self, **labels):
+        '''
+        :return: a context manager (or decorator) which increments the gauge on entry and decrements it on exit.
+        '''
+        gauge = self
+
+        class _InProgress(ContextDecorator):
+            def __enter__(self):
+                gauge.inc(**labels)
+
+            def __exit__(self, *exc):
+                gauge.dec(**labels)
+                return False
+
+        return _InProgress()
+
+
+class Histogram(_Metric):
+    '''
+    Counts observations into cumulative buckets.
+    '''
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets = self.buckets + (math.inf,)
+        super().__init__(name, description, labels)
+
+    def _initial_value(self):
+        return [0] * len(self.buckets), 0
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def drain(self):
+        '''
+        :return: the observations accumulated since the last drain, resetting them to zero.
+        '''
+        with self._lock:
+            values = self._values
+            self._values = {key: self._initial_value() for key in values}
+        return values
+
+    def merge(self, values):
+        '''
+        Adds observations drained from another process.
+        :param values: the drained values.
+        '''
+        with self._lock:
+            for key, (counts, total) in values.items():
+                current_counts, current_total = self._values.get(key, self._initial_value())
+                self._values[key] = ([a + b for a, b in zip(current_counts, counts)], current_total + total)
+
+    def time(self, **labels):
+        '''
+        :return: a context manager (or decorator) which observes the elapsed time in seconds.
+        '''
+        histogram = self
+
+        class _Timer(ContextDecorator):
+            def __enter__(self):
+                self.start = time.monotonic()
+
+            def __exit__(self, *exc):
+                histogram.observe(time.monotonic() - self.start, **labels)
+                return False
+
+        return _Timer()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(key + (('le', _format_value(bound)),))} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {counts[-1]}")
+        return lines
+
+
+def render():
+    '''
+    :return: every registered metric in the Prometheus text exposition format.
+    '''
+    return '\n'.join(line for m in registry for line in m.render()) + '\n'
+
+
+def drain():
+    '''
+    :return: the counter and histogram values accumulated since the last drain, e.g. for a child process to hand to its
+    parent.
+    '''
+    return {m.name: m.drain() for m in registry if isinstance(m, (Counter, Histogram))}
+
+
+def merge(drained):
+    '''
+    Adds the values drained from another process to the metrics in this process.
+    :param drained: the drained values.
+    '''
+    by_name = {m.name: m for m in registry}
+    for name, values in drained.items():
+        by_name[name].merge(values)
+
+
+def write(path):
+    '''
+    Writes the metrics to a file, e.g. for the node exporter textfile collector.
+    :param path: the file to write.
+    '''
+    with open(path, 'w') as f:
+        f.write(render())
+    main_logger.info(f"Written metrics to {path}")
+
+
+def serve(address):
+    '''
+    Exposes the metrics at http://address/metrics from a background thread.
+    :param address: the (host, port) to listen on.
+    :return: the server.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            main_logger.debug(f"metrics request from {self.client_address[0]} : {format % args}")
+
+    server = ThreadingHTTPServer(address, Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    main_logger.warning(f"Serving metrics on http://{address[0]}:{address[1]}/metrics")
+    return server
+
+
+discs_scanned = Counter('madmeasurer_discs_scanned_total', 'Number of discs or files found by the search', ('type',))
+search_seconds = Histogram('madmeasurer_search_seconds', 'Time taken to search a path')
+bd_open_seconds = Histogram('madmeasurer_bd_open_seconds', 'Time taken by libbluray to open a disc',
+                            buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+bd_process_seconds = Histogram('madmeasurer_bd_process_seconds', 'Time taken to open and process a disc')
+measurement_checks = Counter('madmeasurer_measurement_checks_total',
+                             'Number of measurement candidates checked by outcome', ('result',))
+queue_depth = Gauge('madmeasurer_measurement_queue_depth', 'Number of measurement jobs waiting for a worker')
+measurements_running = Gauge('madmeasurer_measurements_running', 'Number of madMeasureHDR processes running')
+measurements = Counter('madmeasurer_measurements_total', 'Number of measurements by result', ('result',))
+measurement_seconds = Histogram('madmeasurer_measurement_seconds', 'Wall time taken by madMeasureHDR')
+measured_bytes = Counter('madmeasurer_measured_bytes_total', 'Size of the source streams measured by madMeasureHDR')
+failures = Counter('madmeasurer_failures_total', 'Number of failures by cause', ('cause',))
+disc_rss_bytes = Gauge('madmeasurer_disc_rss_bytes', 'RSS of the process which processed the last disc')
+disc_workers_recycled = Counter('madmeasurer_disc_workers_recycled_total',
+                                'Number of disc workers replaced by reason', ('reason',))
+copies = Counter('madmeasurer_copies_total', 'Number of measurement file copies by result', ('result',))
+copied_bytes = Counter('madmeasurer_copied_bytes_total', 'Size of the measurement files copied')
@@ -0,0 +1,226 @@
+import argparse
+import json
+import math
+import os
+import re
+import statistics
+import time
+from datetime import datetime
+
+from madmeasurer.loggers import main_logger
+from madmeasurer.metrics import queue_depth
+
+# used when there is no history to predict from, i.e. assume madMeasureHDR runs at real time or 50MB/s
+DEFAULT_SECONDS_PER_CONTENT_SECOND = 1.0
+DEFAULT_SECONDS_PER_BYTE = 1 / (50 * 1024 * 1024)
+# only the most recent measurements are used so predictions follow hardware or driver changes
+HISTORY_WINDOW = 50
+
+DEFAULT_HISTORY_FILE = os.path.join(os.path.expanduser('~'), '.madmeasurer', 'history.jsonl')
+
+
+def parse_duration(value):
+    '''
+    Parses a duration like 8h, 90m, 1h30m or 3600 (seconds).
+    :param value: the value.
+    :return: the duration in seconds.
+    '''
+    if value.isdigit():
+        return int(value)
+    match = re.fullmatch(r'(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s)?', value.strip().lower())
+    if match is None or not any(match.groups()):
+        raise argparse.ArgumentTypeError(f"{value} is not a valid duration, e.g. 8h, 90m, 1h30m")
+    h, m, s = (int(g) if g else 0 for g in match.groups())
+    return h * 3600 + m * 60 + s
+
+
+def record_measurement(history_file, target, duration, size, elapsed, ok):
+    '''
+    Appends a measurement to the history.
+    :param history_file: the history file.
+    :param target: the file measured.
+    :param duration: the content duration in seconds, if known.
+    :param size: the size of the source in bytes, if known.
+    :param elapsed: the wall time taken by madMeasureHDR in seconds.
+    :param ok: whether madMeasureHDR succeeded.
+    '''
+    entry = {'ts': datetime.now().isoformat(), 'target': target, 'duration': duration, 'size': size,
+             'elapsed': round(elapsed, 3), 'ok': ok}
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+        with open(history_file, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+    except OSError:
+        main_logger.exception(f"Unable to record measurement history in {history_file}")
+
+
+def load_history(history_file):
+    '''
+    Reads the successful measurements from the history.
+    :param history_file: the history file.
+    :return: the entries, oldest first.
+    '''
+    entries = []
+    if os.path.exists(history_file):
+        with open(history_file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('ok') is True and entry.get('elapsed', 0) > 0:
+                    entries.append(entry)
+    return entries
+
+
+class Predictor:
+    '''
+    Predicts how long madMeasureHDR will take from the wall time of previous measurements relative to the content
+    duration or, if that is unknown, the source size.
+    '''
+
+    def __init__(self, history):
+        recent = history[-HISTORY_WINDOW:]
+        by_duration = [e['elapsed'] / e['duration'] for e in recent if e.get('duration')]
+        by_size = [e['elapsed'] / e['size'] for e in recent if e.get('size')]
+        self.seconds_per_content_second = statistics.median(by_duration) if by_duration else None
+        self.seconds_per_byte = statistics.median(by_size) if by_size else None
+        main_logger.info(f"Predicting from {len(recent)} measurements : {self.seconds_per_content_second} s/s, "
+                         f"{self.seconds_per_byte} s/byte")
+
+    def predict(self, duration, size):
+        '''
+        :param duration: the content duration in seconds, if known.
+        :param size: the source size in bytes, if known.
+        :return: the predicted wall time in seconds.
+        '''
+        if duration and self.seconds_per_content_second is not None:
+            return duration * self.seconds_per_content_second
+        if size and self.seconds_per_byte is not None:
+            return size * self.seconds_per_byte
+        if duration:
+            return duration * DEFAULT_SECONDS_PER_CONTENT_SECOND
+        return (size or 0) * DEFAULT_SECONDS_PER_BYTE
+
+
+class PlannedJob:
+    '''
+    A measurement waiting to be scheduled.
+    '''
+
+    def __init__(self, target, duration, size, is_main, predicted):
+        self.target = target
+        self.duration = duration
+        self.size = size
+        self.is_main = is_main
+        self.predicted = predicted
+
+    @property
+    def value(self):
+        '''
+        :return: the amount of content this job measures, in seconds where known.
+        '''
+        return self.duration if self.duration else self.predicted
+
+
+def select(jobs, capacity):
+    '''
+    Chooses the jobs which measure the most content within the capacity, i.e. a 0/1 knapsack where the weight of a job
+    is its predicted duration rounded up to the minute so the chosen jobs never add up to more than the capacity.
+    :param jobs: the candidate jobs.
+    :param capacity: the time available in seconds.
+    :return: the chosen jobs, in the order given.
+    '''
+    minutes = int(capacity // 60)
+    if minutes < 0:
+        return []
+    weights = [math.ceil(j.predicted / 60) for j in jobs]
+    best = [0] * (minutes + 1)
+    taken = []
+    for job, weight in zip(jobs, weights):
+        taken_at = bytearray(minutes + 1)
+        for c in range(minutes, weight - 1, -1):
+            candidate = best[c - weight] + job.value
+            if candidate > best[c]:
+                best[c] = candidate
+                taken_at[c] = 1
+        taken.append(taken_at)
+    chosen = []
+    c = minutes
+    for i in range(len(jobs) - 1, -1, -1):
+        if taken[i][c]:
+            chosen.append(jobs[i])
+            c -= weights[i]
+    chosen.reverse()
+    return chosen
+
+
+class BudgetPlanner:
+    '''
+    Collects the measurement jobs found by the search and then runs the jobs which measure the most content in the time
+    budget, main titles first then extras in whatever time the main titles leave. The choice is made again after every
+    measurement against the time that is actually left so a job is only started if its predicted duration fits and
+    jobs are never killed halfway.
+    '''
+
+    def __init__(self, budget, history_file):
+        self.budget = budget
+        self.deadline = time.monotonic() + budget
+        self.predictor = Predictor(load_history(history_file))
+        self.jobs = []
+
+    def submit(self, target, duration=None, is_main=False):
+        '''
+        Queues a measurement job.
+        :param target: the file to measure.
+        :param duration: the content duration in seconds, if known.
+        :param is_main: true if this is a main title.
+        '''
+        from madmeasurer.helpers import get_measure_source_size
+        if any(j.target == target for j in self.jobs):
+            return
+        try:
+            size = get_measure_source_size(target)
+        except (OSError, ValueError):
+            main_logger.exception(f"Unable to determine size of {target}")
+            size = None
+        job = PlannedJob(target, duration, size, is_main, self.predictor.predict(duration, size))
+        main_logger.info(f"Planned {'main' if is_main else 'extra'} : {target} predicted {job.predicted:.0f}s")
+        self.jobs.append(job)
+        queue_depth.inc()
+
+    def plan(self, remaining):
+        '''
+        :param remaining: the time left in seconds.
+        :return: the jobs to run, main titles first, and the jobs which do not fit.
+        '''
+        mains = select([j for j in self.jobs if j.is_main], remaining)
+        left = remaining - sum(math.ceil(j.predicted / 60) * 60 for j in mains)
+        chosen = mains + select([j for j in self.jobs if not j.is_main], left)
+        chosen_ids = {id(j) for j in chosen}
+        return chosen, [j for j in self.jobs if id(j) not in chosen_ids]
+
+    def run(self, args):
+        '''
+        Runs the planned jobs which fit in the remaining budget.
+        :param args: the cli args.
+        :return: the jobs which were run and the jobs which were left for the next run.
+        '''
+        from madmeasurer import run_mad_measure_hdr
+        ran = []
+        while True:
+            remaining = self.deadline - time.monotonic()
+            chosen, deferred = self.plan(remaining)
+            if not chosen:
+                break
+            job = chosen[0]
+            self.jobs.remove(job)
+            queue_depth.dec()
+            main_logger.warning(f"Measuring {job.target}, predicted {job.predicted:.0f}s with {remaining:.0f}s remaining")
+            run_mad_measure_hdr(job.target, args, duration=job.duration)
+            ran.append(job)
+        queue_depth.dec(len(deferred))
+        for job in deferred:
+            main_logger.warning(f"Deferring {job.target}, predicted {job.predicted:.0f}s but {max(remaining, 0):.0f}s remaining")
+        main_logger.error(f"Time budget complete : {len(ran)} measured, {len(deferred)} deferred to the next run")
+        return ran, deferred
@@ -0,0 +1,175 @@
+import atexit
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from madmeasurer.loggers import main_logger
+
+DEFAULT_PROBE_CACHE = os.path.join(os.path.expanduser('~'), '.madmeasurer', 'probe-cache.jsonl')
+
+
+def probe_mkv(target):
+    '''
+    Examines the mkv with enzyme.
+    :param target: the mkv.
+    :return: a dict describing the largest video track.
+    '''
+    import enzyme
+    with open(target, 'rb') as mkv_f:
+        mkv = enzyme.MKV(mkv_f)
+    result = {'width': None, 'height': None, 'codec': None, 'is_uhd': False}
+    if len(mkv.video_tracks) > 0:
+        v = max(mkv.video_tracks, key=lambda t: t.display_width or 0)
+        result.update({'width': v.display_width, 'height': v.display_height, 'codec': v.codec_id,
+                       'is_uhd': v.display_width is not None and v.display_width > 1920})
+    return result
+
+
+# extension -> function which examines the file and returns a json serialisable dict with at least an is_uhd key
+PROBERS = {
+    'mkv': probe_mkv
+}
+
+
+class ProbeCache:
+    '''
+    A persistent cache of probe results keyed by path and validated against the size, mtime and inode of the file.
+    Each result is appended to the cache file as soon as it is known so nothing is lost if the run is killed, save
+    compacts the file by dropping results which have been superseded.
+    '''
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file or None
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__lines = 0
+        if self.cache_file is not None and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                            self.__entries[entry['path']] = entry
+                        except (ValueError, KeyError, TypeError):
+                            # e.g. the last line was cut short by a kill
+                            continue
+                        self.__lines += 1
+                main_logger.info(f"Loaded {len(self.__entries)} probe results from {self.cache_file}")
+            except OSError:
+                main_logger.exception(f"Unable to read probe cache {self.cache_file}, ignoring")
+
+    @staticmethod
+    def __signature(st):
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, target, st):
+        '''
+        :param target: the file.
+        :param st: the current stat of the file.
+        :return: the cached result or None if the file is unknown or has changed.
+        '''
+        with self.__lock:
+            entry = self.__entries.get(target)
+        if entry is not None and entry['signature'] == self.__signature(st):
+            return entry['result']
+        return None
+
+    def put(self, target, st, result):
+        '''
+        Caches the result and appends it to the cache file.
+        :param target: the file.
+        :param st: the stat of the file when it was probed.
+        :param result: the probe result.
+        '''
+        entry = {'path': target, 'signature': self.__signature(st), 'result': result}
+        with self.__lock:
+            self.__entries[target] = entry
+            if self.cache_file is None:
+                return
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+                with open(self.cache_file, 'a') as f:
+                    f.write(json.dumps(entry) + '\n')
+                self.__lines += 1
+            except OSError:
+                main_logger.exception(f"Unable to write probe cache {self.cache_file}")
+
+    def save(self):
+        '''
+        Rewrites the cache file without the superseded results, if there are any.
+        '''
+        with self.__lock:
+            if self.cache_file is None or self.__lines <= len(self.__entries):
+                return
+            try:
+                tmp = f"{self.cache_file}.tmp"
+                with open(tmp, 'w') as f:
+                    for entry in self.__entries.values():
+                        f.write(json.dumps(entry) + '\n')
+                os.replace(tmp, self.cache_file)
+                self.__lines = len(self.__entries)
+            except OSError:
+                main_logger.exception(f"Unable to write probe cache {self.cache_file}")
+
+
+__caches = {}
+__caches_lock = threading.Lock()
+
+
+def get_probe_cache(cache_file):
+    '''
+    :param cache_file: the cache file.
+    :return: the (shared) cache backed by that file.
+    '''
+    with __caches_lock:
+        if cache_file not in __caches:
+            __caches[cache_file] = ProbeCache(cache_file)
+            atexit.register(__caches[cache_file].save)
+        return __caches[cache_file]
+
+
+def probe(target, extension, cache):
+    '''
+    Probes the target, using the cached result if the file is unchanged.
+    :param target: the file.
+    :param extension: the file extension.
+    :param cache: the probe cache.
+    :return: the probe result or None if the file could not be probed.
+    '''
+    try:
+        st = os.stat(target)
+        result = cache.get(target, st)
+        if result is None:
+            result = PROBERS[extension](target)
+            cache.put(target, st, result)
+        else:
+            main_logger.debug(f"Using cached probe result for {target}")
+        return result
+    except Exception:
+        main_logger.exception(f"Unable to probe {target}")
+        return None
+
+
+def probe_all(targets, extension, args):
+    '''
+    Probes the targets concurrently, yielding results in the order the targets were found.
+    :param targets: the files.
+    :param extension: the file extension.
+    :param args: the cli args.
+    :return: a generator of (target, probe result).
+    '''
+    cache = get_probe_cache(args.probe_cache)
+    try:
+        with ThreadPoolExecutor(max_workers=args.probe_concurrency, thread_name_prefix='probe') as executor:
+            window = []
+            for target in targets:
+                window.append((target, executor.submit(probe, target, extension, cache)))
+                # bound the number of outstanding probes so results flow while the search is still running
+                if len(window) >= args.probe_concurrency * 4:
+                    t, f = window.pop(0)
+                    yield t, f.result()
+            for t, f in window:
+                yield t, f.result()
+    finally:
+        cache.save()
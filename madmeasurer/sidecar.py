@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import platform
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+from madmeasurer import disc_index
+from madmeasurer.helpers import mount_iso_on_windows, dismount_iso_on_windows
+from madmeasurer.loggers import main_logger
+
+MANIFEST = 'sidecar.json'
+METADATA_DIRS = [os.path.join('BDMV', 'PLAYLIST'), os.path.join('BDMV', 'CLIPINF')]
+METADATA_FILES = [os.path.join('BDMV', 'index.bdmv'), os.path.join('BDMV', 'MovieObject.bdmv'), 'disc.inf']
+# measurement files are only recorded as empty placeholders, they answer existence checks without a mount
+MEASUREMENT_SUFFIXES = ('.measurements', '.measurements.incomplete')
+
+
+def get_sidecar_path(store, iso):
+    '''
+    :param store: the sidecar store directory.
+    :param iso: the iso.
+    :return: the directory holding the sidecar for this iso.
+    '''
+    iso = os.path.abspath(iso)
+    digest = hashlib.sha1(os.path.normcase(iso).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(store, f"{Path(iso).stem}-{digest}")
+
+
+def __signature(iso):
+    st = os.stat(iso)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def __read_manifest(sidecar):
+    try:
+        with open(os.path.join(sidecar, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def __write_manifest(sidecar, manifest):
+    tmp = os.path.join(sidecar, f"{MANIFEST}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(sidecar, MANIFEST))
+
+
+def is_current(sidecar, iso):
+    '''
+    :param sidecar: the sidecar directory.
+    :param iso: the iso.
+    :return: true if the sidecar was extracted from the iso as it is now, i.e. the size and mtime are unchanged.
+    '''
+    manifest = __read_manifest(sidecar)
+    return manifest is not None and manifest.get('signature') == __signature(iso)
+
+
+def extract(iso, mounted_path, sidecar):
+    '''
+    Copies the disc metadata from the mounted iso into the sidecar.
+    :param iso: the iso.
+    :param mounted_path: the path the iso is mounted on.
+    :param sidecar: the sidecar directory.
+    '''
+    signature = __signature(iso)
+    if os.path.exists(sidecar):
+        shutil.rmtree(sidecar)
+    copied = 0
+    for d in METADATA_DIRS:
+        os.makedirs(os.path.join(sidecar, d))
+        src_dir = os.path.join(mounted_path, d)
+        if os.path.isdir(src_dir):
+            with os.scandir(src_dir) as it:
+                for entry in it:
+                    if entry.is_file():
+                        dest = os.path.join(sidecar, d, entry.name)
+                        if entry.name.endswith(MEASUREMENT_SUFFIXES):
+                            open(dest, 'w').close()
+                        else:
+                            shutil.copyfile(entry.path, dest)
+                            copied += 1
+    for f in METADATA_FILES + [os.path.join('BDMV', f"index.bdmv{s}") for s in MEASUREMENT_SUFFIXES]:
+        src = os.path.join(mounted_path, f)
+        if os.path.isfile(src):
+            if f.endswith(MEASUREMENT_SUFFIXES):
+                open(os.path.join(sidecar, f), 'w').close()
+            else:
+                shutil.copyfile(src, os.path.join(sidecar, f))
+                copied += 1
+    __write_manifest(sidecar, {'iso': os.path.abspath(iso), 'signature': signature})
+    main_logger.info(f"Extracted {copied} metadata files from {iso} to {sidecar}")
+
+
+def get_or_extract_sidecar(iso, store):
+    '''
+    Gets the sidecar for the iso, mounting the iso to extract it if there is no current sidecar.
+    :param iso: the iso.
+    :param store: the sidecar store directory.
+    :return: the sidecar directory or None if it could not be extracted.
+    '''
+    sidecar = get_sidecar_path(store, iso)
+    if is_current(sidecar, iso):
+        main_logger.debug(f"Using sidecar {sidecar} for {iso}")
+        return sidecar
+    if platform.system() != "Windows":
+        main_logger.error(f"Unable to extract sidecar for {iso}, mounting is only supported on Windows")
+        return None
+    mounted_path = mount_iso_on_windows(iso)
+    if mounted_path is None:
+        return None
+    try:
+        extract(iso, mounted_path, sidecar)
+        return sidecar
+    except OSError:
+        main_logger.exception(f"Unable to extract sidecar for {iso}")
+        return None
+    finally:
+        dismount_iso_on_windows(iso)
+
+
+def find_sidecar(target):
+    '''
+    Finds the sidecar, if any, which the target lies in.
+    :param target: a path.
+    :return: (sidecar directory, manifest) or (None, None).
+    '''
+    for parent in list(Path(os.path.abspath(target)).parents)[:3]:
+        if os.path.isfile(os.path.join(parent, MANIFEST)):
+            return str(parent), __read_manifest(str(parent))
+    return None, None
+
+
+@contextmanager
+def measurement_target(target, args):
+    '''
+    A context manager which, if the target is in a sidecar, mounts the iso it was extracted from and yields the
+    equivalent path on the mounted iso so that madMeasureHDR can read the streams. The sidecar is updated to reflect
+    any measurement files written once the measurement completes.
+    :param target: the measurement target.
+    :param args: the cli args.
+    :return: the path to measure or None if the iso could not be mounted, in which case the measurement is skipped.
+    '''
+    sidecar, manifest = find_sidecar(target)
+    if sidecar is None or manifest is None or args.dry_run is True:
+        yield target
+        return
+    iso = manifest['iso']
+    mounted_path = mount_iso_on_windows(iso) if platform.system() == "Windows" else None
+    if mounted_path is None:
+        main_logger.error(f"Unable to mount {iso} to measure {target}, skipping")
+        yield None
+        return
+    relative = os.path.relpath(os.path.abspath(target), sidecar)
+    try:
+        yield os.path.join(mounted_path, relative)
+    finally:
+        try:
+            for s in MEASUREMENT_SUFFIXES:
+                placeholder = os.path.join(sidecar, f"{relative}{s}")
+                if os.path.exists(os.path.join(mounted_path, f"{relative}{s}")):
+                    open(placeholder, 'w').close()
+                elif os.path.exists(placeholder):
+                    os.remove(placeholder)
+            disc_index.refresh(os.path.join(sidecar, relative))
+        finally:
+            dismount_iso_on_windows(iso)
+        manifest['signature'] = __signature(iso)
+        __write_manifest(sidecar, manifest)
@@ -2,6 +2,7 @@ import os
 
 from bluread.objects import TicksToTuple
 
+from madmeasurer import disc_index
 from madmeasurer.loggers import main_logger
 
 
@@ -112,7 +113,7 @@ def get_main_title_by_jriver(bd, bd_folder_path, resolution='seconds'):
 
 def __read_playlists_from_disc_inf(bd, bd_folder_path):
     candidate_titles = {}
-    if os.path.exists(os.path.join(bd_folder_path, 'disc.inf')):
+    if disc_index.exists(os.path.join(bd_folder_path, 'disc.inf')):
         obfuscated_playlists = None
         with open(os.path.join(bd_folder_path, 'disc.inf'), mode='r') as f:
             for line in f:
@@ -204,7 +205,7 @@ def get_playlist_file_size(root_path, title):
     :param title: the title.
     :return: the file size.
     '''
-    return os.path.getsize(os.path.abspath(os.path.join(root_path, 'BDMV', 'PLAYLIST', title.Playlist)))
+    return disc_index.getsize(os.path.abspath(os.path.join(root_path, 'BDMV', 'PLAYLIST', title.Playlist)))
 
 
 def get_max_video_resolution(title):
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(scope='session', autouse=True)
+def stop_log_writer():
+    # the log handlers hold the stdout pytest captures so write out anything pending before pytest closes it
+    yield
+    from madmeasurer.loggers import shutdown
+    shutdown()
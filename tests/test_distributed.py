@@ -0,0 +1,118 @@
+import os
+import socket
+import stat
+import subprocess
+import sys
+import time
+
+import pytest
+
+from madmeasurer.distributed import Coordinator, DONE, FAILED, LEASED, PENDING
+
+# the first attempt at a target named slow* hangs so the worker running it can be killed mid measurement, a target
+# named bad* always fails and anything else succeeds
+FAKE_MAD_MEASURE_HDR = f'''#!{sys.executable}
+import os, sys, time
+target = sys.argv[1]
+print(f"madMeasureHDR fake {{target}}", flush=True)
+name = os.path.basename(target)
+if name.startswith('bad'):
+    sys.exit(1)
+if name.startswith('slow') and not os.path.exists(f"{{target}}.attempted"):
+    open(f"{{target}}.attempted", 'w').close()
+    time.sleep(60)
+open(f"{{target}}.measurements", 'w').close()
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until(predicate, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError()
+        time.sleep(0.1)
+
+
+@pytest.fixture
+def fake_exe_dir(tmp_path):
+    exe_dir = tmp_path / 'exe'
+    exe_dir.mkdir()
+    exe = exe_dir / 'madMeasureHDR.exe'
+    exe.write_text(FAKE_MAD_MEASURE_HDR)
+    exe.chmod(exe.stat().st_mode | stat.S_IXUSR)
+    return exe_dir
+
+
+def start_worker(address, exe_dir, tmp_path):
+    return subprocess.Popen([sys.executable, '-m', 'madmeasurer', '-v', '--work-for', address,
+                             '--mad-measure-path', str(exe_dir), '--history-file', str(tmp_path / 'history.jsonl')],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def test_expired_lease_is_requeued():
+    coordinator = Coordinator('127.0.0.1:0', lease_seconds=0.2, max_attempts=3)
+    coordinator.submit('a.ts')
+    job = coordinator.handle({'op': 'lease', 'worker': 'w1'})['job']
+    assert coordinator.summary()[LEASED] == 1
+    time.sleep(0.3)
+    assert coordinator.handle({'op': 'heartbeat', 'worker': 'w1', 'id': job['id']})['ok'] is False
+    release = coordinator.handle({'op': 'lease', 'worker': 'w2'})['job']
+    assert release['id'] == job['id']
+    assert release['attempt'] == 2
+    # the result from the worker which lost the lease is ignored
+    assert coordinator.handle({'op': 'complete', 'worker': 'w1', 'id': job['id'], 'ok': True})['ok'] is False
+    assert coordinator.handle({'op': 'complete', 'worker': 'w2', 'id': job['id'], 'ok': True})['ok'] is True
+    assert coordinator.summary()[DONE] == 1
+
+
+def test_job_fails_after_max_attempts():
+    coordinator = Coordinator('127.0.0.1:0', lease_seconds=60, max_attempts=2)
+    coordinator.submit('bad.ts')
+    coordinator.finish_discovery()
+    for attempt in (1, 2):
+        job = coordinator.handle({'op': 'lease', 'worker': 'w1'})['job']
+        assert job['attempt'] == attempt
+        coordinator.handle({'op': 'complete', 'worker': 'w1', 'id': job['id'], 'ok': False})
+    assert coordinator.summary() == {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 1}
+    assert coordinator.handle({'op': 'lease', 'worker': 'w1'}) == {'done': True}
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='the fake madMeasureHDR.exe is a python script with a shebang')
+def test_workers_measure_all_jobs_when_one_is_killed(tmp_path, fake_exe_dir):
+    targets = {name: tmp_path / name for name in ('slow.ts', 'a.ts', 'b.ts', 'bad.ts')}
+    for t in targets.values():
+        t.touch()
+    address = f"127.0.0.1:{free_port()}"
+    coordinator = Coordinator(address, lease_seconds=2, max_attempts=2)
+    coordinator.start()
+    workers = []
+    try:
+        coordinator.submit(str(targets['slow.ts']))
+        doomed = start_worker(address, fake_exe_dir, tmp_path)
+        workers.append(doomed)
+        wait_until(lambda: os.path.exists(f"{targets['slow.ts']}.attempted"))
+        doomed.kill()
+        doomed.wait()
+
+        for name in ('a.ts', 'b.ts', 'bad.ts'):
+            coordinator.submit(str(targets[name]))
+        coordinator.finish_discovery()
+        survivor = start_worker(address, fake_exe_dir, tmp_path)
+        workers.append(survivor)
+
+        assert coordinator.wait() == {PENDING: 0, LEASED: 0, DONE: 3, FAILED: 1}
+        assert survivor.wait(timeout=30) == 0
+        for name in ('slow.ts', 'a.ts', 'b.ts'):
+            assert os.path.exists(f"{targets[name]}.measurements")
+        assert not os.path.exists(f"{targets['bad.ts']}.measurements")
+    finally:
+        coordinator.stop()
+        for w in workers:
+            if w.poll() is None:
+                w.kill()
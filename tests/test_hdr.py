@@ -0,0 +1,92 @@
+import pytest
+
+from madmeasurer.hdr import DOLBY_VISION, HDR10, HDR10_PLUS, SDR, get_title_dynamic_range, read_clip_video_streams
+from madmeasurer.helpers import get_playlist_clip_names
+
+HEVC = 0x24
+H264 = 0x1b
+AC3 = 0x81
+
+
+def hevc(dynamic_range_type, hdr10_plus=False):
+    # 2160p/23.976, 16:9, BT.2020
+    return bytes([HEVC, 0x81, 0x30, (dynamic_range_type << 4) | 0x02, 0x80 if hdr10_plus else 0x00])
+
+
+def clpi(*streams):
+    '''
+    A clpi file holding a single program with the given (pid, attributes) streams in its ProgramInfo.
+    '''
+    program = bytearray()
+    program += (0).to_bytes(4, 'big')  # SPN_program_sequence_start
+    program += (0x100).to_bytes(2, 'big')  # program_map_PID
+    program += bytes([len(streams), 0])  # number_of_streams_in_ps, num_of_groups
+    for pid, attr in streams:
+        program += pid.to_bytes(2, 'big') + bytes([len(attr)]) + attr
+    program_info = (len(program) + 2).to_bytes(4, 'big') + bytes([0, 1]) + program
+    header = b'HDMV0300' + (0).to_bytes(4, 'big') + (40).to_bytes(4, 'big')
+    return header + bytes(40 - len(header)) + program_info
+
+
+def mpls(*clips):
+    '''
+    An mpls file whose PlayList holds a play item per clip.
+    '''
+    items = bytearray()
+    for clip in clips:
+        item = clip.encode('ascii') + b'M2TS' + bytes(11)
+        items += len(item).to_bytes(2, 'big') + item
+    playlist = bytes(2) + len(clips).to_bytes(2, 'big') + (0).to_bytes(2, 'big') + items
+    header = b'MPLS0300' + (40).to_bytes(4, 'big')
+    return header + bytes(40 - len(header)) + (len(playlist)).to_bytes(4, 'big') + playlist
+
+
+@pytest.fixture
+def bd_folder(tmp_path):
+    (tmp_path / 'BDMV' / 'PLAYLIST').mkdir(parents=True)
+    (tmp_path / 'BDMV' / 'CLIPINF').mkdir()
+    return tmp_path
+
+
+def write_disc(bd_folder, playlists, clips):
+    for name, content in playlists.items():
+        (bd_folder / 'BDMV' / 'PLAYLIST' / name).write_bytes(content)
+    for name, content in clips.items():
+        (bd_folder / 'BDMV' / 'CLIPINF' / f"{name}.clpi").write_bytes(content)
+
+
+def test_read_clip_video_streams(tmp_path):
+    clip = tmp_path / '00001.clpi'
+    clip.write_bytes(clpi((0x1011, hevc(1, hdr10_plus=True)), (0x1100, bytes([AC3, 0x61, 0x65, 0x6e, 0x67]))))
+    assert read_clip_video_streams(str(clip)) == [{'pid': 0x1011, 'coding_type': 'HEVC', 'format': '2160p',
+                                                   'dynamic_range': HDR10, 'color_space': 'BT.2020',
+                                                   'hdr10_plus': True}]
+
+
+def test_read_clip_video_streams_rejects_other_files(tmp_path):
+    clip = tmp_path / '00001.clpi'
+    clip.write_bytes(mpls('00001'))
+    with pytest.raises(ValueError):
+        read_clip_video_streams(str(clip))
+
+
+def test_get_playlist_clip_names(tmp_path):
+    playlist = tmp_path / '00800.mpls'
+    playlist.write_bytes(mpls('00001', '00002', '00001'))
+    assert get_playlist_clip_names(str(playlist)) == ['00001', '00002', '00001']
+
+
+@pytest.mark.parametrize('clips,expected', [
+    ({'00001': clpi((0x1011, bytes([H264, 0x61, 0x30])))}, SDR),
+    ({'00001': clpi((0x1011, hevc(1)))}, HDR10),
+    ({'00001': clpi((0x1011, hevc(1))), '00002': clpi((0x1011, hevc(1, hdr10_plus=True)))}, HDR10_PLUS),
+    ({'00001': clpi((0x1011, hevc(1)), (0x1015, hevc(2)))}, DOLBY_VISION),
+])
+def test_get_title_dynamic_range(bd_folder, clips, expected):
+    write_disc(bd_folder, {'00800.mpls': mpls(*clips.keys())}, clips)
+    assert get_title_dynamic_range(str(bd_folder), '00800.mpls') == expected
+
+
+def test_get_title_dynamic_range_is_none_if_a_clip_is_missing(bd_folder):
+    write_disc(bd_folder, {'00800.mpls': mpls('00001', '00002')}, {'00001': clpi((0x1011, hevc(1)))})
+    assert get_title_dynamic_range(str(bd_folder), '00800.mpls') is None
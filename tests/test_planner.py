@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+import madmeasurer
+from madmeasurer import planner
+from madmeasurer.metrics import queue_depth
+from madmeasurer.planner import BudgetPlanner
+
+HOUR = 3600
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(planner.time, 'monotonic', fake)
+    return fake
+
+
+def make_planner(tmp_path, budget, titles):
+    budget_planner = BudgetPlanner(budget, str(tmp_path / 'history.jsonl'))
+    for name, hours, is_main in titles:
+        target = tmp_path / name
+        target.touch()
+        budget_planner.submit(str(target), duration=hours * HOUR, is_main=is_main)
+    return budget_planner
+
+
+def depth():
+    return float(queue_depth.render()[-1].split()[-1])
+
+
+def names(jobs):
+    return sorted(os.path.basename(j.target) for j in jobs)
+
+
+def test_plan_fits_the_most_content(tmp_path, clock):
+    budget_planner = make_planner(tmp_path, 5 * HOUR, [('a.ts', 1, True), ('b.ts', 1, True), ('c.ts', 1, True),
+                                                       ('d.ts', 4, True)])
+    chosen, deferred = budget_planner.plan(5 * HOUR)
+    assert sum(j.duration for j in chosen) == 5 * HOUR
+    assert len(chosen) == 2
+    assert 'd.ts' in names(chosen)
+    assert len(deferred) == 2
+
+
+def test_plan_fills_time_left_by_main_titles_with_extras(tmp_path, clock):
+    budget_planner = make_planner(tmp_path, 5 * HOUR, [('main.ts', 3, True), ('x1.ts', 1, False),
+                                                       ('x2.ts', 2, False), ('x3.ts', 3, False)])
+    chosen, deferred = budget_planner.plan(5 * HOUR)
+    assert names(chosen) == ['main.ts', 'x2.ts']
+    assert names(deferred) == ['x1.ts', 'x3.ts']
+
+
+def test_run_measures_the_chosen_jobs_within_the_budget(tmp_path, clock, monkeypatch):
+    measured = []
+
+    def fake_run(target, args, duration=None):
+        measured.append(target)
+        clock.now += duration
+        return True
+
+    monkeypatch.setattr(madmeasurer, 'run_mad_measure_hdr', fake_run)
+    initial_depth = depth()
+    budget_planner = make_planner(tmp_path, 5 * HOUR, [('a.ts', 1, True), ('b.ts', 1, True), ('c.ts', 1, True),
+                                                       ('d.ts', 4, True)])
+    assert depth() == initial_depth + 4
+    ran, deferred = budget_planner.run(None)
+    assert depth() == initial_depth
+    assert names(ran) == sorted(os.path.basename(t) for t in measured)
+    assert sum(j.duration for j in ran) == 5 * HOUR
+    assert len(deferred) == 2